@@ -0,0 +1,321 @@
+'''Benchmark the scripts on synthetic data: generate large inputs at a configurable scale, time each script on them
+through cli.py, and compare the results of two runs (e.g. two commits) to catch regressions.
+Each benchmark runs in its own process, so its wall time and peak RSS can be measured independently.
+'''
+import argparse
+import json
+import os
+import platform
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import date, timedelta
+
+root_dir = os.path.dirname(os.path.abspath(__file__))
+words = ('the quick brown fox jumps over lazy dog lorem ipsum dolor sit amet consectetur adipiscing elit sed do '
+         'eiusmod tempor incididunt ut labore et dolore magna aliqua bug fix deploy review meeting notes').split()
+
+def random_text(rand, size):
+    '''Generate roughly size characters of words, split into lines'''
+    out, length = [], 0
+    while length < size:
+        line = ' '.join(rand.choice(words) for _ in range(rand.randint(5, 15)))
+        out.append(line)
+        length += len(line) + 1
+    return '\n'.join(out)
+
+def generate_diaro(path, entries, text_size=1000, seed=0):
+    '''Write a diaro backup xml file with entries entries of about text_size characters each'''
+    rand = random.Random(seed)
+    with open(path, 'w') as f:
+        f.write('<?xml version="1.0" encoding="UTF-8"?>\n<data version="2">\n<table name="diaro_folders">')
+        for i in range(10):
+            f.write(f'<r><uid>f{i}</uid><title>Folder {i}</title><color>#ffffff</color></r>')
+        f.write('</table>\n<table name="diaro_tags">')
+        for i in range(50):
+            f.write(f'<r><uid>t{i}</uid><title>tag{i}</title></r>')
+        f.write('</table>\n<table name="diaro_entries">')
+        for i in range(entries):
+            entry_tags = ','.join(f't{rand.randrange(50)}' for _ in range(rand.randrange(4)))
+            folder = f'f{rand.randrange(10)}' if rand.random() < 0.7 else ''
+            text = random_text(rand, text_size).replace('&', '&amp;').replace('<', '&lt;')
+            f.write(
+                f'<r><uid>e{i}</uid><date>{1262304000000 + i * 28800000}</date><title>Entry {i}</title>'
+                f'<text>{text}</text><folder_uid>{folder}</folder_uid><tags>,{entry_tags},</tags></r>\n'
+            )
+        f.write('</table>\n</data>\n')
+    return entries
+
+def generate_readme_tree(path, dirs, fanout=8, seed=0):
+    '''Create a tree of dirs sub-directories, fanout per directory, most of which have a README'''
+    rand = random.Random(seed)
+    os.makedirs(path, exist_ok=True)
+    with open(os.path.join(path, 'README.md'), 'w') as f:
+        f.write('# Benchmark\n\nA synthetic tree of READMEs\n\n')
+    level, created, readmes = [path], 0, 0
+    while created < dirs:
+        next_level = []
+        for parent in level:
+            for i in range(fanout):
+                if created >= dirs:
+                    break
+                sub = os.path.join(parent, f'dir{i}')
+                os.makedirs(sub, exist_ok=True)
+                created += 1
+                next_level.append(sub)
+                if rand.random() < 0.9:
+                    readmes += 1
+                    with open(os.path.join(sub, 'README.md'), 'w') as f:
+                        f.write(f'# Project {created}\n\n{random_text(rand, 400)}\n\n```bash\n# not a heading\n```\n\n')
+                        f.write(f'## Usage\n\n{random_text(rand, 2000)}\n')
+        level = next_level
+    return readmes
+
+def generate_images(path, count, width=1240, height=1754, pdf_every=10, seed=0):
+    '''Create count scanned page like images (JPEG and PNG), with every pdf_every-th page as a single page pdf'''
+    import img2pdf
+    from PIL import Image, ImageDraw
+    rand = random.Random(seed)
+    os.makedirs(path, exist_ok=True)
+    for i in range(count):
+        # Lines of dark blocks on a noisy white page, roughly like text
+        im = Image.effect_noise((width, height), 8).point(lambda v: 200 + v // 5).convert('RGB')
+        draw = ImageDraw.Draw(im)
+        for y in range(100, height - 100, 40):
+            x = 100
+            while x < width - 200:
+                w = rand.randint(20, 90)
+                draw.rectangle([x, y, x + w, y + 18], fill=(rand.randint(0, 60),) * 3)
+                x += w + 15
+        name = os.path.join(path, f'page{i:05d}')
+        if pdf_every and i % pdf_every == pdf_every - 1:
+            with open(name + '.jpg.tmp', 'wb') as f:
+                im.save(f, format='JPEG', quality=85)
+            with open(name + '.pdf', 'wb') as f:
+                f.write(img2pdf.convert(name + '.jpg.tmp'))
+            os.remove(name + '.jpg.tmp')
+        elif i % 3 == 0:
+            im.convert('L').save(name + '.png')
+        else:
+            im.save(name + '.jpg', quality=85, dpi=(150, 150))
+    return count
+
+def generate_timesheet(path, days, per_day=8, issues=500, seed=0):
+    '''Write a timesheet covering days days, with per_day entries a day'''
+    rand = random.Random(seed)
+    day = date(2015, 1, 1)
+    entries = 0
+    with open(path, 'w') as f:
+        f.write('# Timesheet\n')
+        for _ in range(days):
+            f.write(f'\n# {day.strftime("%d/%m/%Y")}{" @logged" if rand.random() < 0.05 else ""}\n\n')
+            start = 8 * 60 + rand.randrange(0, 60, 5)
+            for _ in range(per_day):
+                end = start + rand.randrange(15, 120, 5)
+                description = random_text(rand, 40).replace('\n', ' ')
+                mentioned = ' and '.join(f'BUG-{rand.randint(1, issues)}' for _ in range(rand.choice([0, 1, 1, 1, 2])))
+                f.write(f'{start // 60 % 24:02d}:{start % 60:02d} - {end // 60 % 24:02d}:{end % 60:02d} - {description} {mentioned}\n')
+                start = end
+                entries += 1
+            day += timedelta(days=1)
+    return entries
+
+dataset_options = ['data_dir', 'scale', 'seed', 'diaro_entries', 'entry_size', 'readme_dirs', 'fanout', 'images', 'image_width', 'image_height', 'timesheet_days']
+
+def dataset_params(args):
+    '''The parameters of each dataset at the requested scale'''
+    return {
+        'diaro': {'entries': int(args.diaro_entries * args.scale), 'text_size': args.entry_size},
+        'readmes': {'dirs': int(args.readme_dirs * args.scale), 'fanout': args.fanout},
+        'images': {'count': int(args.images * args.scale), 'width': args.image_width, 'height': args.image_height},
+        'timesheet': {'days': int(args.timesheet_days * args.scale), 'per_day': 8},
+    }
+
+def generate(args):
+    '''Generate any datasets which don't exist yet at the requested scale, returning {dataset: (path, items)}'''
+    params = dataset_params(args)
+    generators = {
+        'diaro': ('backup.xml', generate_diaro),
+        'readmes': ('readmes', generate_readme_tree),
+        'images': ('images', generate_images),
+        'timesheet': ('timesheet.md', generate_timesheet),
+    }
+    os.makedirs(args.data_dir, exist_ok=True)
+    state_file = os.path.join(args.data_dir, 'datasets.json')
+    state = {}
+    if os.path.isfile(state_file):
+        with open(state_file, 'r') as f:
+            state = json.load(f)
+    datasets = {}
+    for name, (filename, generator) in generators.items():
+        path = os.path.join(args.data_dir, filename)
+        if state.get(name, {}).get('params') != params[name] or not os.path.exists(path):
+            print(f'Generating {name} dataset: {params[name]}')
+            if os.path.isdir(path):
+                shutil.rmtree(path)
+            start = time.perf_counter()
+            items = generator(path, **params[name], seed=args.seed)
+            state[name] = {'params': params[name], 'items': items}
+            print(f'    {items} items in {time.perf_counter() - start:.1f}s')
+            with open(state_file, 'w') as f:
+                json.dump(state, f, indent=2)
+        datasets[name] = (path, state[name]['items'])
+    return datasets
+
+def run_command(command):
+    '''Run a command, returning its wall time in seconds and peak RSS in MB'''
+    with tempfile.TemporaryFile('w+') as stderr:
+        start = time.perf_counter()
+        process = subprocess.Popen(command, stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL, stderr=stderr, cwd=root_dir)
+        _, status, usage = os.wait4(process.pid, 0)
+        wall = time.perf_counter() - start
+        process.returncode = os.waitstatus_to_exitcode(status)
+        if process.returncode != 0:
+            stderr.seek(0)
+            sys.stderr.write(stderr.read())
+            raise Exception(f'benchmark command failed with exit code {process.returncode}: {" ".join(command)}')
+    # ru_maxrss is in KB on Linux
+    return wall, usage.ru_maxrss / 1024
+
+def get_benchmarks(datasets, out_dir, jobs):
+    '''Get {benchmark: (command, items, unit)}'''
+    cli = [sys.executable, os.path.join(root_dir, 'cli.py')]
+    diaro, diaro_entries = datasets['diaro']
+    readmes, readme_count = datasets['readmes']
+    images, image_count = datasets['images']
+    timesheet, timesheet_entries = datasets['timesheet']
+    return {
+        'diaro-convert': (cli + ['diaro-export', '-f', diaro, '-o', os.path.join(out_dir, 'diary.md')], diaro_entries, 'entries'),
+        'diaro-convert-stream': (cli + ['diaro-export', '-s', '-f', diaro, '-o', os.path.join(out_dir, 'diary.md')], diaro_entries, 'entries'),
+        'generate-readme': (cli + ['generate-readme', '-d', readmes, '-R', '-i', '--no-cache'], readme_count, 'readmes'),
+        'create-pdf': (cli + ['create-pdf', '-j', str(jobs), '-o', os.path.join(out_dir, 'merged.pdf'), '-d', images], image_count, 'files'),
+        'create-pdf-low-memory': (cli + ['create-pdf', '-l', '-j', str(jobs), '-o', os.path.join(out_dir, 'merged.pdf'), '-d', images], image_count, 'files'),
+        'timesheet-parse': (cli + ['jira-timesheet', '--file', timesheet, '--projects', 'BUG', '--parse-only'], timesheet_entries, 'entries'),
+    }
+
+def git_commit():
+    try:
+        result = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=root_dir, capture_output=True, text=True, check=True)
+        dirty = subprocess.run(['git', 'status', '--porcelain', '--untracked-files=no'], cwd=root_dir, capture_output=True, text=True)
+        return result.stdout.strip() + ('-dirty' if dirty.stdout.strip() else '')
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def run(args):
+    # Generate in a separate process: a child's peak RSS starts from the size of this process when it is forked, so
+    # this process must not grow by loading Pillow etc.
+    command = [sys.executable, os.path.abspath(__file__), 'generate']
+    for option in dataset_options:
+        command += ['--' + option.replace('_', '-'), str(getattr(args, option))]
+    subprocess.run(command, check=True)
+    datasets = generate(args)
+    out_dir = os.path.join(args.data_dir, 'out')
+    benchmarks = get_benchmarks(datasets, out_dir, args.jobs)
+    selected = args.only or list(benchmarks)
+
+    results = {}
+    print(f'{"benchmark":<24}  {"wall s":>8}  {"peak RSS MB":>11}  {"throughput":>18}')
+    for name in selected:
+        command, items, unit = benchmarks[name]
+        walls, rss = [], 0
+        for _ in range(args.repeat):
+            shutil.rmtree(out_dir, ignore_errors=True)
+            os.makedirs(out_dir)
+            wall, peak = run_command(command)
+            walls.append(wall)
+            rss = max(rss, peak)
+        # The fastest run is the least affected by noise from the rest of the machine
+        wall = min(walls)
+        results[name] = {
+            'wall_s': round(wall, 4),
+            'wall_runs_s': [round(w, 4) for w in walls],
+            'peak_rss_mb': round(rss, 1),
+            'items': items,
+            'unit': unit,
+            'throughput': round(items / wall, 1),
+        }
+        print(f'{name:<24}  {wall:>8.2f}  {rss:>11.1f}  {items / wall:>10.1f} {unit}/s')
+    shutil.rmtree(out_dir, ignore_errors=True)
+
+    report = {
+        'commit': git_commit(),
+        'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'cpus': os.cpu_count(),
+        'jobs': args.jobs,
+        'datasets': dataset_params(args),
+        'results': results,
+    }
+    with open(args.output, 'w') as f:
+        json.dump(report, f, indent=2)
+    print(f'Results written to {args.output}')
+
+def compare(args):
+    '''Compare two results files, exiting with an error if any benchmark got slower or used more memory than allowed'''
+    with open(args.base, 'r') as f:
+        base = json.load(f)
+    with open(args.new, 'r') as f:
+        new = json.load(f)
+    if base.get('datasets') != new.get('datasets'):
+        print('WARNING: the results were measured on different datasets', file=sys.stderr)
+    print(f'{base.get("commit")} -> {new.get("commit")}')
+    print(f'{"benchmark":<24}  {"wall s":>17}  {"change":>8}  {"peak RSS MB":>17}  {"change":>8}')
+    regressions = []
+    for name, result in new['results'].items():
+        if name not in base['results']:
+            continue
+        old = base['results'][name]
+        wall_change = (result['wall_s'] - old['wall_s']) / old['wall_s'] * 100
+        rss_change = (result['peak_rss_mb'] - old['peak_rss_mb']) / old['peak_rss_mb'] * 100
+        flags = []
+        if wall_change > args.threshold:
+            flags.append('SLOWER')
+        if rss_change > args.rss_threshold:
+            flags.append('MORE MEMORY')
+        if flags:
+            regressions.append(name)
+        print(
+            f'{name:<24}  {old["wall_s"]:>7.2f} -> {result["wall_s"]:>6.2f}  {wall_change:>+7.1f}%  '
+            f'{old["peak_rss_mb"]:>7.1f} -> {result["peak_rss_mb"]:>6.1f}  {rss_change:>+7.1f}%  {" ".join(flags)}'
+        )
+    if regressions:
+        sys.exit(f'Regressions in: {", ".join(regressions)}')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark the scripts on synthetic data and compare results between commits')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    for command in ['generate', 'run']:
+        sub = subparsers.add_parser(command, help='Generate the synthetic datasets' if command == 'generate' else 'Run the benchmarks, generating any missing datasets')
+        sub.add_argument('--data-dir', default=os.path.join(os.path.expanduser('~'), '.cache', 'python_scripts_benchmark'), help='Directory to keep the generated datasets in')
+        sub.add_argument('--scale', type=float, default=1.0, help='Multiply the size of every dataset by this factor')
+        sub.add_argument('--seed', type=int, default=0, help='Seed for generating datasets')
+        sub.add_argument('--diaro-entries', type=int, default=50000, help='Number of entries in the diaro backup (default: 50000, ~55MB)')
+        sub.add_argument('--entry-size', type=int, default=1000, help='Characters of text in each diaro entry')
+        sub.add_argument('--readme-dirs', type=int, default=2000, help='Number of directories in the README tree')
+        sub.add_argument('--fanout', type=int, default=8, help='Sub-directories per directory in the README tree')
+        sub.add_argument('--images', type=int, default=200, help='Number of scanned pages (images and pdfs)')
+        sub.add_argument('--image-width', type=int, default=1240, help='Width of scanned pages in pixels')
+        sub.add_argument('--image-height', type=int, default=1754, help='Height of scanned pages in pixels')
+        sub.add_argument('--timesheet-days', type=int, default=5 * 365, help='Number of days in the timesheet')
+        if command == 'run':
+            sub.add_argument('--output', '-o', default='benchmark_results.json', help='JSON file to write results to')
+            sub.add_argument('--repeat', type=int, default=3, help='Number of times to run each benchmark, the fastest run is kept')
+            sub.add_argument('--jobs', '-j', type=int, default=1, help='Number of processes for scripts which support them')
+            sub.add_argument('--only', nargs='+', metavar='BENCHMARK', help='Only run these benchmarks')
+        sub.set_defaults(func=run if command == 'run' else generate)
+
+    sub = subparsers.add_parser('compare', help='Compare two results files')
+    sub.add_argument('base', help='Results of the baseline, e.g. the previous commit')
+    sub.add_argument('new', help='Results to check for regressions')
+    sub.add_argument('--threshold', type=float, default=10, help='Percentage increase in wall time counted as a regression (default: 10)')
+    sub.add_argument('--rss-threshold', type=float, default=10, help='Percentage increase in peak RSS counted as a regression (default: 10)')
+    sub.set_defaults(func=compare)
+
+    args = parser.parse_args()
+    args.func(args)
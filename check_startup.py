@@ -0,0 +1,57 @@
+'''Guard against startup time regressions of cli.py: for each subcommand, time --help and check which modules it imports.
+Fails if a subcommand imports one of the heavy dependencies, or takes longer than the budget over a bare interpreter.
+'''
+import argparse
+import os
+import subprocess
+import sys
+import time
+
+from cli import tools
+
+# Dependencies which must only be imported once a script actually runs
+heavy_modules = ['ansible', 'jira', 'requests', 'dateutil', 'PyPDF2', 'PIL', 'img2pdf']
+
+def best_time(command, repeat):
+    '''Get the fastest wall time of running a command, in milliseconds'''
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        subprocess.run(command, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, check=True)
+        times.append((time.perf_counter() - start) * 1000)
+    return min(times)
+
+def imported_modules(command):
+    '''Get the top level packages imported by a command, from the output of python -X importtime'''
+    result = subprocess.run(command[:1] + ['-X', 'importtime'] + command[1:], stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, text=True, check=True)
+    modules = set()
+    for line in result.stderr.splitlines():
+        if line.startswith('import time:') and line.count('|') == 2:
+            modules.add(line.rsplit('|', 1)[1].strip().split('.')[0])
+    return modules
+
+def check(args):
+    cli = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'cli.py')
+    baseline = best_time([sys.executable, '-c', 'pass'], args.repeat)
+    print(f'{"subcommand":<20}  {"--help ms":>9}  {"overhead ms":>11}  heavy imports')
+    failed = False
+    for name in ['--help'] + list(tools):
+        command = [sys.executable, cli] + ([name, '--help'] if name != '--help' else ['--help'])
+        elapsed = best_time(command, args.repeat)
+        heavy = sorted(imported_modules(command) & set(heavy_modules))
+        overhead = elapsed - baseline
+        slow = overhead > args.budget
+        failed = failed or slow or bool(heavy)
+        print(f'{name:<20}  {elapsed:>9.1f}  {overhead:>11.1f}{" SLOW" if slow else "     "}  {", ".join(heavy) or "-"}')
+    print(f'(bare interpreter: {baseline:.1f} ms, budget: {args.budget:.0f} ms)')
+    if failed:
+        sys.exit('startup check failed')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Check the startup time and imports of cli.py subcommands')
+    parser.add_argument('--budget', type=float, default=100, help='Maximum milliseconds --help may take over a bare interpreter (default: 100)')
+    parser.add_argument('--repeat', type=int, default=5, help='Number of runs to take the fastest time of')
+
+    args = parser.parse_args()
+    check(args)
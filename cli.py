@@ -0,0 +1,42 @@
+'''Run any of the scripts from a single entry point, e.g. python cli.py create-pdf --help
+A script is only imported when its subcommand runs, and the scripts import their heavy dependencies (ansible, jira,
+PyPDF2, ...) only once their arguments have been parsed, so --help and argument errors return quickly.
+'''
+import argparse
+import importlib
+import os
+import sys
+
+# Subcommand: (directory, module, description)
+tools = {
+    'diaro-export': ('diaro_export', 'diaro_backup_to_md', 'Export a diaro backup xml file to markdown'),
+    'generate-readme': ('generate_readme', 'generate_readme', 'Generate a README.md file with summaries of READMEs in sub-directories'),
+    'create-pdf': ('create_pdf', 'create_pdf', 'Create a PDF file by merging existing pdf files and/or images'),
+    'jira-timesheet': ('jira_timesheet', 'timesheet', 'Upload worklogs to JIRA from a plaintext timesheet file'),
+    'unmanaged-packages': ('unmanaged_packages', 'unmanaged_packages', 'Report packages on hosts which are not installed by an ansible playbook'),
+}
+
+def load_tool(name):
+    '''Import the module of a tool, with its directory on the path so it can import its sibling modules'''
+    directory, module, _ = tools[name]
+    sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), directory))
+    return importlib.import_module(module)
+
+def get_parser():
+    parser = argparse.ArgumentParser(
+        description='Run one of the python utility scripts',
+        epilog='subcommands:\n' + '\n'.join(f'  {name:<20}{description}' for name, (_, _, description) in tools.items()),
+        formatter_class=argparse.RawDescriptionHelpFormatter
+    )
+    parser.add_argument('tool', choices=tools, metavar='subcommand', help='Script to run, see below')
+    parser.add_argument('args', nargs=argparse.REMAINDER, help='Arguments for the script, see %(prog)s SUBCOMMAND --help')
+    return parser
+
+def main(argv=None):
+    parser = get_parser()
+    args = parser.parse_args(argv)
+    load_tool(args.tool).main(args.args, prog=f'{parser.prog} {args.tool}')
+
+
+if __name__ == '__main__':
+    main()
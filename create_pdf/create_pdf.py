@@ -5,40 +5,404 @@
 # Last Updated: June 2020
 ########################################
 
+from concurrent.futures import ProcessPoolExecutor
 from io import BytesIO
-from PyPDF2 import PdfFileMerger
-from PIL import Image
 from functools import partial
 import argparse
-import img2pdf
+import gc
+import hashlib
+import itertools
+import json
+import mmap
 import os
 import re
+import tempfile
+import time
 
 supported_formats = ['pdf', 'jpeg', 'jpg', 'png', 'bmp']
 
+# Page attributes which can be inherited from parent nodes in the page tree
+inheritable_attributes = ['/Resources', '/MediaBox', '/CropBox', '/Rotate']
+
 def alphanum_key(s):
     '''Create a natutal sorting key
     From: https://nedbatchelder.com/blog/200712/human_sorting.html
     '''
     return [ int(c) if c.isdigit() else c for c in re.split('(\d+)', s) ]
 
-def merge(files, output_file):
-    '''Merge multiple pdf files'''
+def preprocess_image(image, options):
+    '''Downsample and recompress an image before it is converted to pdf, returning the new image as bytes.
+    Options: max_size (longest side in pixels), dpi (target resolution), quality (JPEG quality) and
+    colour ('colour', 'grayscale' or 'bilevel').
+    '''
+    from PIL import Image
+    with Image.open(image) as im:
+        # img2pdf assumes 96 dpi for images without a resolution
+        dpi = im.info.get('dpi', (96, 96))[0] or 96
+        scale = 1
+        if options.get('dpi') and dpi > options['dpi']:
+            scale = options['dpi'] / dpi
+        if options.get('max_size'):
+            scale = min(scale, options['max_size'] / max(im.size))
+        if scale < 1:
+            # Scale the resolution with the image, so the page size stays the same
+            im = im.resize((max(1, round(im.width * scale)), max(1, round(im.height * scale))), Image.LANCZOS)
+            dpi = dpi * scale
+        out = BytesIO()
+        if options.get('colour') == 'bilevel':
+            im.convert('1').save(out, format='TIFF', compression='group4', dpi=(dpi, dpi))
+        else:
+            im = im.convert('L' if options.get('colour') == 'grayscale' else 'RGB')
+            im.save(out, format='JPEG', quality=options.get('quality') or 85, optimize=True, dpi=(dpi, dpi))
+    return out.getvalue()
+
+def load_image(data, options=None):
+    '''Prepare image data for conversion, preprocessing it if options are given.
+    Returns the image data and (original size, new size, seconds spent) if it was preprocessed, or None.
+    '''
+    if not options:
+        return data, None
+    start = time.perf_counter()
+    new_data = preprocess_image(BytesIO(data), options)
+    return new_data, (len(data), len(new_data), time.perf_counter() - start)
+
+def cache_path(cache_dir, data, options):
+    '''Get the path of the cached pdf for image data converted with the given options'''
+    import img2pdf
+    key = hashlib.sha256(data)
+    key.update(json.dumps([options, img2pdf.__version__], sort_keys=True).encode('utf-8'))
+    digest = key.hexdigest()
+    return os.path.join(cache_dir, digest[:2], f'{digest}.pdf')
+
+def get_cached(path):
+    '''Check if a page is in the cache, marking it as recently used for LRU eviction'''
+    if path and os.path.isfile(path):
+        os.utime(path)
+        return True
+    return False
+
+def write_cached(path, pdf):
+    '''Add a converted page to the cache, atomically so concurrent workers never see partial files'''
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp = f'{path}.{os.getpid()}.tmp'
+    with open(tmp, 'wb') as f:
+        f.write(pdf)
+    os.replace(tmp, path)
+
+def evict_cache(cache_dir, max_bytes):
+    '''Remove the least recently used pages from the cache until it is no larger than max_bytes'''
+    pages = []
+    for root, _, names in os.walk(cache_dir):
+        for name in names:
+            st = os.stat(os.path.join(root, name))
+            pages.append((st.st_mtime, st.st_size, os.path.join(root, name)))
+    size = sum(page[1] for page in pages)
+    for _, page_size, path in sorted(pages):
+        if size <= max_bytes:
+            break
+        os.remove(path)
+        size -= page_size
+
+def convert_image(image, options=None, cache_dir=None):
+    '''Convert an image to a single page pdf, returned as bytes along with any preprocessing stats'''
+    import img2pdf
+    with open(image, 'rb') as f:
+        data = f.read()
+    cached = cache_path(cache_dir, data, options) if cache_dir else None
+    if get_cached(cached):
+        with open(cached, 'rb') as f:
+            return f.read(), None
+    data, stats = load_image(data, options)
+    pdf = img2pdf.convert(data)
+    if cached:
+        write_cached(cached, pdf)
+    return pdf, stats
+
+def convert_image_to_file(image, output_file, options=None, cache_dir=None):
+    '''Convert an image to a single page pdf file, returning its path along with any preprocessing stats.
+    Pages found in the cache are used directly instead of being written to output_file.
+    '''
+    import img2pdf
+    with open(image, 'rb') as f:
+        data = f.read()
+    cached = cache_path(cache_dir, data, options) if cache_dir else None
+    if get_cached(cached):
+        return cached, None
+    data, stats = load_image(data, options)
+    pdf = img2pdf.convert(data)
+    if cached:
+        write_cached(cached, pdf)
+        return cached, stats
+    with open(output_file, 'wb') as f:
+        f.write(pdf)
+    return output_file, stats
+
+def print_stats(image, stats, totals):
+    '''Print the bytes saved and time spent preprocessing an image, adding them to the totals'''
+    if stats:
+        before, after, seconds = stats
+        print(f'{image}: {before} -> {after} bytes ({before - after} saved) in {seconds:.2f}s')
+        totals[:] = [t + s for t, s in zip(totals, stats)]
+
+def print_totals(totals):
+    '''Print the total bytes saved and time spent preprocessing images'''
+    before, after, seconds = totals
+    if before:
+        print(f'Preprocessing saved {before - after} of {before} bytes ({100 * (before - after) / before:.1f}%) in {seconds:.2f}s')
+
+def map_file(path):
+    '''Memory-map a file read-only, so its contents are paged in from disk on demand instead of read into memory'''
+    with open(path, 'rb') as f:
+        return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+def merge_low_memory(files, output_file, jobs=1, tmpdir=None, options=None, cache_dir=None, batch_size=50):
+    '''Merge multiple pdf files while keeping memory use bounded.
+    Converted images are spilled to temporary files instead of being held in memory, and the output is built in batches
+    of batch_size files: the first batch is written normally and each following batch is appended to it as an
+    incremental update, so only one batch of (memory-mapped) inputs is ever loaded at a time.
+    '''
+    from PyPDF2 import PdfFileReader, PdfFileWriter
+    if not files:
+        return
+    totals = [0, 0, 0]
+    executor = ProcessPoolExecutor(max_workers=jobs or None) if jobs != 1 else None
+    try:
+        with tempfile.TemporaryDirectory(dir=tmpdir) as tmp:
+            images = [f for f in files if not f.endswith('pdf')]
+            pages = [os.path.join(tmp, f'{i}.pdf') for i in range(len(images))]
+            converted = (executor.map if executor else map)(partial(convert_image_to_file, options=options, cache_dir=cache_dir), images, pages)
+            for start in range(0, len(files), batch_size):
+                paths, maps, readers = [], [], []
+                try:
+                    for pdf in files[start:start + batch_size]:
+                        if not pdf.endswith('pdf'):
+                            converted_file, stats = next(converted)
+                            print_stats(pdf, stats, totals)
+                        paths.append(pdf if pdf.endswith('pdf') else converted_file)
+                        maps.append(map_file(paths[-1]))
+                    readers = [PdfFileReader(m) for m in maps]
+                    if start == 0:
+                        writer = PdfFileWriter()
+                        for reader in readers:
+                            for page in reader.pages:
+                                writer.addPage(page)
+                        with open(output_file, 'wb') as f:
+                            writer.write(f)
+                        del writer
+                    elif not append_pages(output_file, readers):
+                        raise Exception(f'Could not append pages to {output_file}')
+                finally:
+                    # Drop the parsed pages of this batch before the next one is loaded. They reference their readers
+                    # in cycles, so collect them now rather than whenever the garbage collector next runs
+                    del readers
+                    gc.collect()
+                    for m in maps:
+                        m.close()
+                    # Converted pages are only needed for their batch (cached pages are kept)
+                    for path in paths:
+                        if os.path.dirname(path) == tmp:
+                            os.remove(path)
+        print_totals(totals)
+    finally:
+        if executor:
+            executor.shutdown(cancel_futures=True)
+
+def merge(files, output_file, jobs=1, options=None, cache_dir=None):
+    '''Merge multiple pdf files, converting (and optionally preprocessing) images to pdf in parallel using jobs processes'''
+    from PyPDF2 import PdfFileMerger
     if files:
         merger = PdfFileMerger()
+        totals = [0, 0, 0]
+        executor = ProcessPoolExecutor(max_workers=jobs or None) if jobs != 1 else None
         try:
+            # Results are yielded in page order as soon as each one is ready, so merging starts with the first page
+            images = (executor.map if executor else map)(partial(convert_image, options=options, cache_dir=cache_dir), [f for f in files if not f.endswith('pdf')])
             for pdf in files:
                 if pdf.endswith('pdf'):
                     merger.append(pdf)
                 else:
-                    f = BytesIO()
-                    with open(pdf, 'rb') as f2:
-                        img2pdf.convert(f2, outputstream=f)
-                        f.seek(0)
-                    merger.append(f)
+                    page, stats = next(images)
+                    print_stats(pdf, stats, totals)
+                    merger.append(BytesIO(page))
             merger.write(output_file)
+            print_totals(totals)
+        finally:
+            if executor:
+                executor.shutdown(cancel_futures=True)
+            merger.close()
+
+def iter_page_refs(ref, inherited=None):
+    '''Walk a page tree, yielding a reference to each page along with the attributes it inherits from its parents'''
+    from PyPDF2.generic import NameObject
+    node = ref.getObject()
+    if node.get('/Type') != '/Pages':
+        yield ref, inherited or {}
+        return
+    inherited = dict(inherited or {})
+    inherited.update({NameObject(key): node.raw_get(key) for key in inheritable_attributes if key in node})
+    for kid in node['/Kids']:
+        yield from iter_page_refs(kid, inherited)
+
+def copy_object(obj, ids, objects, refs):
+    '''Copy a pdf object from another file. Objects it references are copied into objects, numbered from the ids counter.
+    refs maps (reader, object number, generation) to the new references, so shared objects are only copied once.
+    Pages are numbered up front, so links to other pages point at their copies; the page tree itself (/Pages nodes, and
+    pages which aren't being copied) is never copied, a reference to it is replaced with null.
+    '''
+    from PyPDF2.generic import ArrayObject, DictionaryObject, IndirectObject, NullObject, StreamObject
+    if isinstance(obj, IndirectObject):
+        key = (id(obj.pdf), obj.idnum, obj.generation)
+        if key not in refs:
+            target = obj.getObject()
+            if isinstance(target, DictionaryObject) and target.get('/Type') in ('/Pages', '/Page'):
+                return NullObject()
+            refs[key] = IndirectObject(next(ids), 0, None)
+            objects[refs[key].idnum] = copy_object(target, ids, objects, refs)
+        return refs[key]
+    if isinstance(obj, StreamObject):
+        new = obj.__class__()
+        new._data = obj._data
+        # The length is always written from the data
+        new.update({key: copy_object(value, ids, objects, refs) for key, value in obj.items() if key != '/Length'})
+        return new
+    if isinstance(obj, DictionaryObject):
+        new = DictionaryObject()
+        new.update({key: copy_object(value, ids, objects, refs) for key, value in obj.items()})
+        return new
+    if isinstance(obj, ArrayObject):
+        return ArrayObject(copy_object(value, ids, objects, refs) for value in obj)
+    return obj
+
+def append_pages(output_file, readers):
+    '''Append the pages of pdfs to an existing pdf file as an incremental update, so the existing contents of the
+    file are never rewritten. Returns False if the file can't be updated incrementally (it uses an xref stream).
+    '''
+    from PyPDF2 import PdfFileReader
+    from PyPDF2.generic import ArrayObject, DictionaryObject, IndirectObject, NameObject, NumberObject
+    with open(output_file, 'r+b') as f:
+        reader = PdfFileReader(f)
+        f.seek(max(0, os.path.getsize(output_file) - 1024))
+        prev = int(re.findall(rb'startxref\s+(\d+)', f.read())[-1])
+        f.seek(prev)
+        if f.read(4) != b'xref':
+            return False
+
+        size = reader.trailer['/Size']
+        pages_ref = reader.trailer['/Root'].raw_get('/Pages')
+        pages = pages_ref.getObject()
+
+        # Number every new page before copying anything, so links between pages resolve to the new pages
+        ids = itertools.count(size)
+        objects, refs, new_pages = {}, {}, []
+        for source in readers:
+            for ref, inherited in iter_page_refs(source.trailer['/Root'].raw_get('/Pages')):
+                key = (id(ref.pdf), ref.idnum, ref.generation)
+                if key not in refs:
+                    refs[key] = IndirectObject(next(ids), 0, None)
+                    new_pages.append((refs[key], ref.getObject(), inherited))
+
+        # Copy new pages (and everything they reference) into the file, parented to the root of the page tree
+        kids = []
+        for new_ref, page, inherited in new_pages:
+            new_page = DictionaryObject()
+            for key, value in list(inherited.items()) + list(page.items()):
+                if key != '/Parent':
+                    new_page[key] = copy_object(value, ids, objects, refs)
+            new_page[NameObject('/Parent')] = pages_ref
+            objects[new_ref.idnum] = new_page
+            kids.append(new_ref)
+
+        new_pages = DictionaryObject(pages)
+        new_pages[NameObject('/Kids')] = ArrayObject(list(pages['/Kids']) + kids)
+        new_pages[NameObject('/Count')] = NumberObject(pages['/Count'] + len(kids))
+
+        # Write the new objects, followed by an xref section and trailer pointing back to the previous one
+        f.seek(0, os.SEEK_END)
+        f.write(b'\n')
+        offsets = {}
+        for idnum, generation, obj in [(pages_ref.idnum, pages_ref.generation, new_pages)] + [(i, 0, o) for i, o in sorted(objects.items())]:
+            offsets[idnum] = (f.tell(), generation)
+            f.write(f'{idnum} {generation} obj\n'.encode('ascii'))
+            obj.writeToStream(f, None)
+            f.write(b'\nendobj\n')
+        xref = f.tell()
+        f.write(b'xref\n')
+        numbers = sorted(offsets)
+        while numbers:
+            run = 1
+            while run < len(numbers) and numbers[run] == numbers[0] + run:
+                run += 1
+            f.write(f'{numbers[0]} {run}\n'.encode('ascii'))
+            for idnum in numbers[:run]:
+                f.write(f'{offsets[idnum][0]:010d} {offsets[idnum][1]:05d} n \n'.encode('ascii'))
+            numbers = numbers[run:]
+        trailer = DictionaryObject()
+        trailer.update({NameObject(key): reader.trailer.raw_get(key) for key in ['/Root', '/Info', '/ID'] if key in reader.trailer})
+        trailer[NameObject('/Size')] = NumberObject(next(ids))
+        trailer[NameObject('/Prev')] = NumberObject(prev)
+        f.write(b'trailer\n')
+        trailer.writeToStream(f, None)
+        f.write(f'\nstartxref\n{xref}\n%%EOF\n'.encode('ascii'))
+    return True
+
+def file_key(path):
+    '''Identify a version of a file by its path, size and mtime'''
+    st = os.stat(path)
+    return [os.path.abspath(path), st.st_size, st.st_mtime_ns]
+
+def manifest_path(output_file):
+    return f'{output_file}.manifest.json'
+
+def write_manifest(output_file, files):
+    '''Record the source files of a pdf, and the version of the pdf they were added to, in a sidecar manifest'''
+    with open(manifest_path(output_file), 'w') as f:
+        json.dump({'output': file_key(output_file), 'files': files}, f)
+
+def append(files, output_file, jobs=1, options=None, cache_dir=None):
+    '''Convert and append only the files which are not already in an existing pdf'''
+    from PyPDF2 import PdfFileMerger, PdfFileReader
+    if not os.path.isfile(manifest_path(output_file)):
+        raise Exception(f'No manifest found for {output_file}, recreate it with --append to track its source files')
+    with open(manifest_path(output_file), 'r') as f:
+        manifest = json.load(f)
+    if manifest['output'] != file_key(output_file):
+        raise Exception(f'{output_file} was modified since it was created, recreate it with --append')
+
+    new_files = [path for path in files if file_key(path) not in manifest['files']]
+    if not new_files:
+        print(f'{output_file} is up to date')
+        return
+
+    executor = ProcessPoolExecutor(max_workers=jobs or None) if jobs != 1 else None
+    try:
+        images = (executor.map if executor else map)(partial(convert_image, options=options, cache_dir=cache_dir), [f for f in new_files if not f.endswith('pdf')])
+        readers, totals = [], [0, 0, 0]
+        for pdf in new_files:
+            if pdf.endswith('pdf'):
+                readers.append(PdfFileReader(pdf))
+            else:
+                page, stats = next(images)
+                print_stats(pdf, stats, totals)
+                readers.append(PdfFileReader(BytesIO(page)))
+        print_totals(totals)
+    finally:
+        if executor:
+            executor.shutdown(cancel_futures=True)
+
+    if not append_pages(output_file, readers):
+        # Files with xref streams can't be appended to with an xref table, so rebuild them instead
+        tmp = f'{output_file}.tmp'
+        merger = PdfFileMerger()
+        try:
+            merger.append(output_file)
+            for reader in readers:
+                merger.append(reader)
+            merger.write(tmp)
         finally:
             merger.close()
+        os.replace(tmp, output_file)
+    write_manifest(output_file, manifest['files'] + [file_key(path) for path in new_files])
+    print(f'Appended {len(new_files)} files to {output_file}')
 
 def create_pdf(args):
     '''Create a pdf file from multiple files'''
@@ -50,26 +414,58 @@ def create_pdf(args):
                 if filen.split('.')[-1] in supported_formats:
                     filtered_files.append(os.path.join(path, filen))
         elif os.path.isfile(path):
-            if filen.split('.')[-1] in supported_formats:
-                filtered_files.append(os.path.join(path, filen))
+            if path.split('.')[-1] in supported_formats:
+                filtered_files.append(path)
         else:
             raise Exception('File or directory does not exist:{}'.format(path))
     if args.files:
         for path in args.files:
             if os.path.isfile(path):
-                add_file(path)
+                filtered_files.append(path)
+
+    # Only preprocess images if asked to
+    options = {k: getattr(args, k) for k in ['max_size', 'dpi', 'quality', 'colour'] if getattr(args, k)}
 
     # Merge files
-    merge(filtered_files, args.output)
+    if args.append and os.path.isfile(args.output):
+        append(filtered_files, args.output, args.jobs, options, args.cache_dir)
+    else:
+        if args.low_memory:
+            merge_low_memory(filtered_files, args.output, args.jobs, args.tmpdir, options, args.cache_dir, args.batch_size)
+        else:
+            merge(filtered_files, args.output, args.jobs, options, args.cache_dir)
+        if args.append:
+            write_manifest(args.output, [file_key(path) for path in filtered_files])
 
-if __name__ == '__main__':
-    parser = argparse.ArgumentParser(description='Create a PDF file by merging existing pdf files and/or images')
+    if args.cache_dir:
+        evict_cache(args.cache_dir, args.cache_size * 1024 * 1024)
+
+def get_parser(prog=None):
+    parser = argparse.ArgumentParser(prog=prog, description='Create a PDF file by merging existing pdf files and/or images')
     parser.add_argument('--output', '-o', help="Output file name", dest='output', required=True)
     parser.add_argument('--filetypes', '-t', choices=['pdf', 'png', 'jpg', 'jpeg'], action='append', default=['pdf', 'png', 'jpg', 'jpeg'], required=False)
     parser.add_argument('--directory', '-d', action='append', default=[], required=False)
+    parser.add_argument('--jobs', '-j', type=int, default=1, help='Number of processes used to convert images (0: number of CPUs)')
+    parser.add_argument('--low-memory', '-l', default=False, action='store_true', help='Keep memory use bounded by spilling converted images to disk and writing the output in batches of files')
+    parser.add_argument('--batch-size', type=int, default=50, help='Number of files loaded at a time in low memory mode (default: 50)')
+    parser.add_argument('--tmpdir', help='Directory for temporary files in low memory mode (default: system temp directory)')
+    parser.add_argument('--max-size', type=int, help='Downsample images so their longest side is at most this many pixels')
+    parser.add_argument('--dpi', type=int, help='Downsample images with a higher resolution to this dpi')
+    parser.add_argument('--quality', type=int, help='JPEG quality to recompress images with (default: 85)')
+    parser.add_argument('--colour', choices=['colour', 'grayscale', 'bilevel'], help='Recompress images in colour, grayscale or black and white (for text scans)')
+    parser.add_argument('--cache-dir', help='Directory to cache converted pages in, so unchanged images are not converted again')
+    parser.add_argument('--cache-size', type=int, default=1024, help='Maximum size of the page cache in MB, least recently used pages are evicted first (default: 1024)')
+    parser.add_argument('--append', '-a', default=False, action='store_true', help='Only convert and append files which are not already in the output file, tracked in OUTPUT.manifest.json')
     parser.add_argument('files', nargs='*', metavar='file')
+    return parser
 
-    args = parser.parse_args()
+def main(argv=None, prog=None):
+    parser = get_parser(prog)
+    args = parser.parse_args(argv)
     if not args.directory and not args.files:
-        print('create_pdf.py: error: one of the following arguments are required: --directory/-d or [files]')
+        parser.error('one of the following arguments are required: --directory/-d or [files]')
     create_pdf(args)
+
+
+if __name__ == '__main__':
+    main()
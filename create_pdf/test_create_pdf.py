@@ -0,0 +1,63 @@
+import os
+import tempfile
+import unittest
+
+from PyPDF2 import PdfFileReader, PdfFileWriter
+from PyPDF2.generic import ArrayObject, DictionaryObject, NameObject, RectangleObject
+
+from create_pdf import append_pages, merge_low_memory
+
+def write_pdf(path, widths, links=()):
+    '''Write a pdf with a blank page per width, and a link for each (page, target page) pair.'''
+    writer = PdfFileWriter()
+    for width in widths:
+        writer.addBlankPage(width, 100)
+    for page, target in links:
+        link = DictionaryObject({
+            NameObject('/Type'): NameObject('/Annot'),
+            NameObject('/Subtype'): NameObject('/Link'),
+            NameObject('/Rect'): RectangleObject([0, 0, 10, 10]),
+            NameObject('/Dest'): ArrayObject([writer.getObject(writer._pages)['/Kids'][target], NameObject('/Fit')]),
+        })
+        writer.getPage(page)[NameObject('/Annots')] = ArrayObject([writer._add_object(link)])
+    with open(path, 'wb') as f:
+        writer.write(f)
+
+def page_widths(reader):
+    return [int(page.mediabox.width) for page in reader.pages]
+
+class AppendPagesTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.base = os.path.join(self.tmp.name, 'base.pdf')
+        self.linked = os.path.join(self.tmp.name, 'linked.pdf')
+        write_pdf(self.base, [192])
+        write_pdf(self.linked, [200, 210, 220], links=[(0, 2)])
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def assert_linked_pages(self, path, widths):
+        with open(path, 'rb') as f:
+            reader = PdfFileReader(f)
+            self.assertEqual(page_widths(reader), widths)
+            # Only the original page tree, no copy of the appended file's tree
+            kids = reader.trailer['/Root']['/Pages']['/Kids']
+            self.assertEqual(len(kids), len(widths))
+            # The link on the first appended page points at the copy of the third
+            link = reader.pages[len(widths) - 3]['/Annots'][0].getObject()
+            self.assertEqual(link['/Dest'][0].idnum, kids[-1].idnum)
+
+    def test_linked_pages(self):
+        with open(self.linked, 'rb') as f:
+            self.assertTrue(append_pages(self.base, [PdfFileReader(f)]))
+        self.assert_linked_pages(self.base, [192, 200, 210, 220])
+
+    def test_merge_low_memory_linked_pages(self):
+        # With a batch size of one, the linked pdf is appended as an incremental update of its own
+        output = os.path.join(self.tmp.name, 'output.pdf')
+        merge_low_memory([self.base, self.linked], output, batch_size=1)
+        self.assert_linked_pages(output, [192, 200, 210, 220])
+
+if __name__ == '__main__':
+    unittest.main()
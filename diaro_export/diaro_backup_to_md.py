@@ -1,48 +1,389 @@
+from concurrent.futures import ProcessPoolExecutor
 from datetime import datetime
 import xml.etree.ElementTree as ET
 import argparse
+import hashlib
+import json
+import os
+import re
+import shutil
+import sqlite3
+import urllib.parse
+import zipfile
 
 tags = {}
 folders = {}
+attachments = {}
+
+def link_path(path, base='.'):
+    '''Get the markdown link destination of a file, relative to base and url quoted (names may contain spaces)'''
+    return urllib.parse.quote(os.path.relpath(path, base).replace(os.sep, '/'))
+
+def format_entry(entry, base='.'):
+    '''Render a single diaro entry (dict of field name -> text) as markdown, linking attachments relative to base'''
+    out = []
+    # Print title
+    dt = datetime.fromtimestamp(int(int(entry.get('date'))/1000)).strftime("%Y-%m-%d %H:%M")
+    title = entry.get('title')
+    out.append(f'# {dt} {title}')
+
+    # Print text
+    out.append('\n\n')
+    out.append(f"{entry.get('text')}")
+    out.append('\n')
+
+    # Print attachments
+    for path in attachments.get(entry.get('uid'), []):
+        out.append(f'![{os.path.basename(path)}]({link_path(path, base)})\n')
+
+    # Print tags
+    entry_tags = entry.get('tags')
+    if entry_tags:
+        for tag in entry_tags.split(','):
+            tag_name = tags.get(tag)
+            if tag_name:
+                out.append(f'#{tag_name} ')
+    folder = entry.get('folder_uid')
+    if folder:
+        folder_name = folders.get(folder)
+        if folder_name:
+            out.append(f'#{folder_name}')
+
+    out.append('\n\n')
+    return ''.join(out)
+
+def get_fields(element):
+    '''Get the fields of a diaro table row as a dict of field name -> text'''
+    return {child.tag: child.text for child in element}
+
+def iter_rows(source):
+    '''Incrementally parse a diaro backup, yielding (table name, fields) for each row as it is completed,
+    and (table name, None) at the end of each table.
+    Parsed rows are discarded as soon as they have been handled, so memory use does not grow with the backup size.
+    '''
+    table = None
+    for event, element in ET.iterparse(source, events=('start', 'end')):
+        if event == 'start':
+            if element.get('name') is not None:
+                table = element
+            continue
+        if element is table:
+            yield table.get('name'), None
+            table = None
+            element.clear()
+        elif element.tag == 'r' and table is not None:
+            yield table.get('name'), get_fields(element)
+            table.remove(element)
+
+def iter_entries(source):
+    '''Incrementally parse a diaro backup, collecting folders and tags and yielding each entry as it is completed.
+    Entries are held back only if they appear before the folders and tags tables have been read.
+    '''
+    pending = []
+    seen = set()
+    for name, fields in iter_rows(source):
+        if fields is None:
+            seen.add(name)
+            if {'diaro_folders', 'diaro_tags'} <= seen:
+                yield from pending
+                pending = []
+        elif name == 'diaro_folders':
+            folders[fields.get('uid')] = fields.get('title')
+        elif name == 'diaro_tags':
+            tags[fields.get('uid')] = fields.get('title')
+        elif name == 'diaro_entries':
+            if {'diaro_folders', 'diaro_tags'} <= seen:
+                yield fields
+            else:
+                pending.append(fields)
+    yield from pending
+
+def open_backup(filename):
+    '''Open the xml of a diaro backup, streaming it straight out of the archive for .diaro (zip) backups'''
+    if zipfile.is_zipfile(filename):
+        with zipfile.ZipFile(filename) as zf:
+            members = [name for name in zf.namelist() if name.endswith('.xml')]
+            if not members:
+                raise Exception(f'No xml file found in diaro backup: {filename}')
+            return zf.open(members[0])
+    return open(filename, 'rb')
+
+def export_media(filename, media_dir):
+    '''Copy the attachments in a .diaro (zip) backup to media_dir, returning a map of file name -> copied path'''
+    media = {}
+    with zipfile.ZipFile(filename) as zf:
+        for info in zf.infolist():
+            name = os.path.normpath(info.filename)
+            # Skip directories, the backup xml and anything that would be copied outside of media_dir
+            if info.is_dir() or name.endswith('.xml') or name.startswith('..') or os.path.isabs(name):
+                continue
+            # Attachments are stored under media/<type>/ in the backup
+            if name.split(os.sep)[0] == 'media':
+                name = os.path.relpath(name, 'media')
+            dest = os.path.join(media_dir, name)
+            # Skip attachments already copied by a previous export
+            if not (os.path.isfile(dest) and os.path.getsize(dest) == info.file_size):
+                os.makedirs(os.path.dirname(dest), exist_ok=True)
+                with zf.open(info) as src, open(dest, 'wb') as dst:
+                    shutil.copyfileobj(src, dst, 1024 * 1024)
+            media[os.path.basename(name)] = dest
+    return media
+
+def load_attachments(args):
+    '''Export the attachments of a backup to --media-dir and map entry uids to their exported files'''
+    if not args.media_dir:
+        return
+    if not zipfile.is_zipfile(args.filename):
+        print(f'WARNING: {args.filename} is not a .diaro backup, skipping attachments')
+        return
+    media = export_media(args.filename, args.media_dir)
+    with open_backup(args.filename) as source:
+        for name, fields in iter_rows(source):
+            if name == 'diaro_attachments' and fields and fields.get('filename') in media:
+                attachments.setdefault(fields.get('entry_uid'), []).append(media[fields.get('filename')])
+
+def convert_stream(args):
+    '''Convert a diaro backup to markdown without loading the whole backup into memory'''
+    load_attachments(args)
+    with open_backup(args.filename) as source, open(args.output, 'w') as f:
+        for entry in iter_entries(source):
+            f.write(format_entry(entry, os.path.dirname(args.output) or '.'))
+
+def init_lookups(tag_map, folder_map, attachment_map):
+    '''Initialise the tag, folder and attachment lookups in a worker process'''
+    tags.update(tag_map)
+    folders.update(folder_map)
+    attachments.update(attachment_map)
+
+def shard_key(entry, shard):
+    '''Get the shard (month, year or folder uid) an entry belongs to, entries without a folder are in the '' folder'''
+    if shard == 'folder':
+        return entry.get('folder_uid') if entry.get('folder_uid') in folders else ''
+    dt = datetime.fromtimestamp(int(int(entry.get('date'))/1000))
+    return dt.strftime('%Y-%m' if shard == 'month' else '%Y')
+
+def shard_title(name, shard):
+    '''Get the title of a shard, as shown in the index'''
+    if shard == 'folder':
+        return folders.get(name) or 'unfiled'
+    return name
+
+def shard_paths(args, names):
+    '''Get the output file of each shard, or the output file itself when not sharding (name None).
+    Shards whose titles map to the same file name are numbered, so they never overwrite each other.
+    '''
+    paths, used = {}, set()
+    for name in sorted(names, key=lambda name: (shard_title(name, args.shard), name) if name is not None else ('', '')):
+        if name is None:
+            paths[name] = args.output
+            continue
+        base = re.sub(r'[^\w\- ]', '_', shard_title(name, args.shard))
+        filename, count = base, 1
+        # Compare case-insensitively, as the shards may be written to a case-insensitive filesystem
+        while filename.lower() in used:
+            count += 1
+            filename = f'{base}-{count}'
+        used.add(filename.lower())
+        paths[name] = os.path.join(os.path.splitext(args.output)[0], filename + '.md')
+    return paths
+
+def group_entries(args):
+    '''Parse the backup and group its entries by shard name (None when not sharding)'''
+    load_attachments(args)
+    shards = {}
+    with open_backup(args.filename) as source:
+        for entry in iter_entries(source):
+            name = shard_key(entry, args.shard) if args.shard else None
+            shards.setdefault(name, []).append(entry)
+    return shards
+
+def write_shard(path, entries):
+    '''Write all entries of a shard to a markdown file'''
+    with open(path, 'w') as f:
+        for entry in entries:
+            f.write(format_entry(entry, os.path.dirname(path) or '.'))
+
+def write_shards(args, shards):
+    '''Render and write shards (dict of path -> entries) in parallel'''
+    for path in shards:
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+    with ProcessPoolExecutor(max_workers=args.jobs, initializer=init_lookups, initargs=(tags, folders, attachments)) as executor:
+        list(executor.map(write_shard, shards.keys(), shards.values()))
+
+def write_index(args, shards, paths):
+    '''Write the index file linking to every shard'''
+    with open(args.output, 'w') as f:
+        f.write('# Index\n\n')
+        for name in paths:
+            path = link_path(paths[name], os.path.dirname(args.output) or '.')
+            f.write(f'- [{shard_title(name, args.shard)}]({path}) ({len(shards[name])} entries)\n')
+
+def convert_sharded(args):
+    '''Convert a diaro backup into one markdown file per shard, plus an index file linking them'''
+    shards = group_entries(args)
+    paths = shard_paths(args, shards)
+    write_shards(args, {paths[name]: entries for name, entries in shards.items()})
+    write_index(args, shards, paths)
+
+def entry_hash(entry):
+    '''Hash the raw fields and attachments of an entry'''
+    content = [entry, attachments.get(entry.get('uid'))]
+    return hashlib.sha1(json.dumps(content, sort_keys=True).encode('utf-8')).hexdigest()
+
+def load_manifest(path):
+    '''Load the manifest of a previous export, or an empty one if there is none'''
+    if os.path.isfile(path):
+        with open(path, 'r') as f:
+            return json.load(f)
+    return {'entries': {}, 'tags': {}, 'folders': {}}
+
+def convert_incremental(args):
+    '''Re-export only the output files containing entries which are new, changed or deleted since the last export'''
+    manifest_path = args.manifest or f'{args.output}.manifest.json'
+    old = load_manifest(manifest_path)
+    shards = group_entries(args)
+
+    # Tags and folders which were added, renamed or removed change the rendering of entries referencing them
+    changed_tags = {uid for uid in set(tags) | set(old['tags']) if tags.get(uid) != old['tags'].get(uid)}
+    changed_folders = {uid for uid in set(folders) | set(old['folders']) if folders.get(uid) != old['folders'].get(uid)}
+
+    shard_files = shard_paths(args, shards)
+    entries, dirty = {}, set()
+    for name, shard_entries in shards.items():
+        path = shard_files[name]
+        if not os.path.isfile(path):
+            dirty.add(path)
+        for entry in shard_entries:
+            info = {'hash': entry_hash(entry), 'location': path}
+            entries[entry.get('uid')] = info
+            prev = old['entries'].get(entry.get('uid'))
+            if prev != info \
+                    or changed_tags.intersection((entry.get('tags') or '').split(',')) \
+                    or entry.get('folder_uid') in changed_folders:
+                dirty.add(path)
+                if prev:
+                    dirty.add(prev['location'])
+    for uid, prev in old['entries'].items():
+        if uid not in entries:
+            dirty.add(prev['location'])
+
+    paths = {shard_files[name]: entries for name, entries in shards.items()}
+    write_shards(args, {path: paths[path] for path in dirty if path in paths})
+    for path in dirty:
+        if path not in paths and os.path.isfile(path):
+            if path == args.output:
+                open(path, 'w').close()
+            else:
+                os.remove(path)
+    if args.shard and dirty:
+        write_index(args, shards, shard_files)
+
+    with open(manifest_path, 'w') as f:
+        json.dump({'entries': entries, 'tags': tags, 'folders': folders}, f)
+    print(f'Rewrote {len(dirty)} of {len(paths)} output files')
+
+SQLITE_SCHEMA = '''
+CREATE TABLE IF NOT EXISTS entries (
+    uid TEXT PRIMARY KEY,
+    date TEXT,
+    title TEXT,
+    text TEXT,
+    tags TEXT,
+    folder TEXT
+);
+CREATE VIRTUAL TABLE IF NOT EXISTS entries_fts USING fts5(
+    title, text, tags, folder, content='entries', content_rowid='rowid'
+);
+CREATE TRIGGER IF NOT EXISTS entries_ai AFTER INSERT ON entries BEGIN
+    INSERT INTO entries_fts(rowid, title, text, tags, folder) VALUES (new.rowid, new.title, new.text, new.tags, new.folder);
+END;
+CREATE TRIGGER IF NOT EXISTS entries_ad AFTER DELETE ON entries BEGIN
+    INSERT INTO entries_fts(entries_fts, rowid, title, text, tags, folder) VALUES ('delete', old.rowid, old.title, old.text, old.tags, old.folder);
+END;
+CREATE TRIGGER IF NOT EXISTS entries_au AFTER UPDATE ON entries BEGIN
+    INSERT INTO entries_fts(entries_fts, rowid, title, text, tags, folder) VALUES ('delete', old.rowid, old.title, old.text, old.tags, old.folder);
+    INSERT INTO entries_fts(rowid, title, text, tags, folder) VALUES (new.rowid, new.title, new.text, new.tags, new.folder);
+END;
+'''
+
+def entry_row(entry):
+    '''Get the sqlite row of an entry, with tag and folder names resolved'''
+    dt = datetime.fromtimestamp(int(int(entry.get('date'))/1000)).strftime("%Y-%m-%d %H:%M")
+    entry_tags = [tags.get(tag) for tag in (entry.get('tags') or '').split(',') if tags.get(tag)]
+    return (entry.get('uid'), dt, entry.get('title'), entry.get('text'), ' '.join(entry_tags), folders.get(entry.get('folder_uid')))
+
+def convert_sqlite(args, batch_size=1000):
+    '''Load diaro entries into a sqlite database with an FTS5 full-text index.
+    Existing databases are refreshed in place: only new or changed entries are written and deleted entries are removed.
+    '''
+    db = sqlite3.connect(args.output)
+    try:
+        db.executescript(SQLITE_SCHEMA)
+        db.execute('CREATE TEMP TABLE seen (uid TEXT PRIMARY KEY)')
+        upsert = '''
+            INSERT INTO entries (uid, date, title, text, tags, folder) VALUES (?, ?, ?, ?, ?, ?)
+            ON CONFLICT(uid) DO UPDATE SET
+                date = excluded.date, title = excluded.title, text = excluded.text,
+                tags = excluded.tags, folder = excluded.folder
+            WHERE (date, title, text, tags, folder) IS NOT (excluded.date, excluded.title, excluded.text, excluded.tags, excluded.folder)
+        '''
+        batch = []
+        with open_backup(args.filename) as source:
+            for entry in iter_entries(source):
+                batch.append(entry_row(entry))
+                if len(batch) >= batch_size:
+                    with db:
+                        db.executemany(upsert, batch)
+                        db.executemany('INSERT OR IGNORE INTO seen VALUES (?)', [(row[0],) for row in batch])
+                    batch = []
+        with db:
+            db.executemany(upsert, batch)
+            db.executemany('INSERT OR IGNORE INTO seen VALUES (?)', [(row[0],) for row in batch])
+            db.execute('DELETE FROM entries WHERE uid NOT IN (SELECT uid FROM seen)')
+    finally:
+        db.close()
 
 def convert(args):
-    tree = ET.parse(args.filename)
+    load_attachments(args)
+    with open_backup(args.filename) as source:
+        tree = ET.parse(source)
     for x in tree.getroot().findall(".//*[@name='diaro_folders']/r"):
         folders[x.find('./uid').text] = x.find('./title').text
     for x in tree.getroot().findall(".//*[@name='diaro_tags']/r"):
         tags[x.find('./uid').text] = x.find('./title').text
     with open(args.output, 'w') as f:
         for entry in tree.getroot().findall(".//*[@name='diaro_entries']/r"):
-            # Print title
-            dt = datetime.fromtimestamp(int(int(entry.find('./date').text)/1000)).strftime("%Y-%m-%d %H:%M")
-            title = entry.find('./title').text
-            f.write(f'# {dt} {title}')
-
-            # Print text
-            f.write('\n\n')
-            f.write(f"{entry.find('./text').text}")
-            f.write('\n')
-
-            # Print tags
-            entry_tags = entry.find('./tags').text
-            if entry_tags:
-                for tag in entry_tags.split(','):
-                    tag_name = tags.get(tag)
-                    if tag_name:
-                        f.write(f'#{tag_name} ')
-            folder = entry.find('./folder_uid').text
-            if folder:
-                folder_name = folders.get(folder)
-                if folder_name:
-                    f.write(f'#{folder_name}')
-
-            f.write('\n\n')
+            f.write(format_entry(get_fields(entry), os.path.dirname(args.output) or '.'))
 
-
-if __name__ == '__main__':
-    parser = argparse.ArgumentParser(description='Export a diaro backup xml file to markdown')
-    parser.add_argument('--filename', '-f', help='Name of diaro xml backup file to convert', required=True)
+def get_parser(prog=None):
+    parser = argparse.ArgumentParser(prog=prog, description='Export a diaro backup xml file to markdown')
+    parser.add_argument('--filename', '-f', help='Name of diaro xml or .diaro (zip) backup file to convert', required=True)
     parser.add_argument('--output', '-o', help='output filename', required=True)
+    parser.add_argument('--stream', '-s', default=False, action='store_true', help='Parse the backup incrementally, keeping memory use constant')
+    parser.add_argument('--shard', choices=['month', 'year', 'folder'], help='Split entries into one file per month, year or folder, with OUTPUT as the index file')
+    parser.add_argument('--jobs', '-j', type=int, default=None, help='Number of processes used to write shards (default: number of CPUs)')
 
-    args = parser.parse_args()
-    convert(args)
\ No newline at end of file
+    parser.add_argument('--media-dir', '-m', help='Directory to copy attachments of a .diaro backup to, linking them from the markdown')
+    parser.add_argument('--incremental', default=False, action='store_true', help='Only rewrite output files containing entries changed since the last export')
+    parser.add_argument('--manifest', help='Manifest file used by --incremental (default: OUTPUT.manifest.json)')
+
+    parser.add_argument('--format', choices=['markdown', 'sqlite'], default='markdown', help='Write markdown, or a sqlite database with a full-text index of entries')
+    return parser
+
+def main(argv=None, prog=None):
+    parser = get_parser(prog)
+    args = parser.parse_args(argv)
+    if args.format == 'sqlite':
+        convert_sqlite(args)
+    elif args.incremental:
+        convert_incremental(args)
+    elif args.shard:
+        convert_sharded(args)
+    elif args.stream:
+        convert_stream(args)
+    else:
+        convert(args)
+
+
+if __name__ == '__main__':
+    main()
@@ -4,8 +4,15 @@
 # Last Updated: June 2020
 ################################
 
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
 import argparse
+import fnmatch
+import hashlib
+import io
+import json
 import os
+import time
 
 def get_summary(file_desc):
     '''Get the summary of a readme file - content between first title and second title'''
@@ -25,16 +32,40 @@ def get_summary(file_desc):
             lines.append(line)
     return title, lines
 
-def generate(args):
-    '''Generate a README.md file'''
+def load_cache(path):
+    '''Load the summary cache, or an empty one if there is none'''
+    if path and os.path.isfile(path):
+        with open(path, 'r') as f:
+            return json.load(f)
+    return {}
+
+def get_cached_summary(path, cache, new_cache):
+    '''Get the summary of a readme file, only re-parsing it if its contents changed since it was cached'''
+    st = os.stat(path)
+    entry = cache.get(path)
+    if not (entry and entry['mtime'] == st.st_mtime_ns and entry['size'] == st.st_size):
+        with open(path, 'rb') as f:
+            data = f.read()
+        digest = hashlib.sha1(data).hexdigest()
+        # Files which were touched but not modified don't need to be parsed again
+        if not (entry and entry['hash'] == digest):
+            title, lines = get_summary(io.TextIOWrapper(io.BytesIO(data)))
+            entry = {'title': title, 'lines': lines, 'hash': digest}
+        entry = dict(entry, mtime=st.st_mtime_ns, size=st.st_size)
+    new_cache[path] = entry
+    return entry['title'], list(entry['lines'])
+
+def get_header(main_file):
+    '''Get the current contents of the generated file, and the title and summary to keep at the top of it'''
     main_doc = []
     main_title = ''
     main_summary = []
 
-    main_file = os.path.join(args.repodir, args.filename)
+    current = None
     if os.path.isfile(os.path.join(main_file)):
         with open(main_file, 'r') as f:
-            main_title, main_summary = get_summary(f)
+            current = f.read()
+        main_title, main_summary = get_summary(io.StringIO(current))
 
     if not (main_title and main_summary):
         # Get Main Repo Title
@@ -54,42 +85,202 @@ def generate(args):
     else:
         main_doc.append(main_title)
         main_doc += main_summary
+    return current, main_doc
+
+def summarise(args, cache, new_cache, name):
+    '''Get the path and summary of the README in a sub-directory, or None if it has none'''
+    subfile = os.path.join(os.path.join(args.repodir, name), args.subfilename)
+    # Ignore hidden directories
+    if name.startswith('.') or not os.path.isfile(subfile):
+        return None
+    return subfile, get_cached_summary(subfile, cache, new_cache)
+
+def render(args, main_doc, names, cache, new_cache):
+    '''Render the generated file from its header and the summaries of READMEs in the named sub-directories.
+    Nested sub-directories are numbered and indented under the closest parent directory with a README.
+    '''
+    main_doc = list(main_doc)
+
+    # Read and summarise READMEs in parallel, map keeps the results in the order of names
+    with ThreadPoolExecutor(max_workers=args.threads) as executor:
+        summaries = list(executor.map(partial(summarise, args, cache, new_cache), names))
 
     # Get Subsection details
     index = ['### Index\n\n']
     subsection = []
-    num = 1
-    for name in os.listdir(args.repodir):
-        subfile = os.path.join(os.path.join(args.repodir, name), args.subfilename)
-        # Ignore hidden directories
-        if not name.startswith('.') and os.path.isfile(subfile):
-            with open(subfile, 'r') as f:
-                subsection_title, subsection_lines = get_summary(f)
-                subsection_title = subsection_title.replace('#', f'{str(num)}.')
-                index.append(f'|--- [{subsection_title}]({os.path.relpath(subfile, args.repodir)})\n\n')
-                subsection.append(f'## {subsection_title}')
-                subsection += subsection_lines
-                subsection.append('\n\n')
-            num+=1
-    
+    numbers, counts = {}, {}
+    for name, summary in zip(names, summaries):
+        if summary is None:
+            continue
+        subfile, (subsection_title, subsection_lines) = summary
+        parent = os.path.dirname(name)
+        while parent and parent not in numbers:
+            parent = os.path.dirname(parent)
+        counts[parent] = counts.get(parent, 0) + 1
+        numbers[name] = numbers.get(parent, '') + f'{counts[parent]}.'
+        level = numbers[name].count('.')
+        subsection_title = subsection_title.replace('#', numbers[name])
+        # Indent with non-breaking spaces, as four leading spaces would make the entry a code block
+        index.append(f'{"&nbsp;" * 4 * (level - 1)}|--- [{subsection_title}]({os.path.relpath(subfile, args.repodir)})\n\n')
+        subsection.append(f'{"#" * min(level + 1, 6)} {subsection_title}')
+        subsection += subsection_lines
+        subsection.append('\n\n')
+
     if args.index:
         main_doc += index
     if not args.nosummary:
         main_doc += subsection
+    return ''.join(main_doc)
+
+def is_ignored(args, path):
+    '''Check if a sub-directory (relative to the root directory) matches any of the ignore patterns'''
+    return any(fnmatch.fnmatch(path, pattern) or fnmatch.fnmatch(os.path.basename(path), pattern) for pattern in args.ignore)
+
+def scan_dir(args, path):
+    '''Get the sorted, non-hidden and non-ignored sub-directories of a directory relative to the root directory'''
+    with os.scandir(os.path.join(args.repodir, path)) as it:
+        children = [
+            os.path.join(path, entry.name) for entry in it
+            if entry.is_dir(follow_symlinks=False) and not entry.name.startswith('.')
+        ]
+    return sorted(child for child in children if not is_ignored(args, child))
+
+def list_subdirs(args):
+    '''List the sub-directories to summarise READMEs from.
+    In recursive mode, directories are walked level by level down to --max-depth, scanning the directories of
+    each level in parallel. The result is always in depth-first, name-sorted order.
+    '''
+    if not args.recursive:
+        return [name for name in os.listdir(args.repodir) if not is_ignored(args, name)]
+    found = []
+    level, depth = [''], 0
+    with ThreadPoolExecutor(max_workers=args.threads) as executor:
+        while level and (args.max_depth is None or depth < args.max_depth):
+            level = [child for children in executor.map(partial(scan_dir, args), level) for child in children]
+            found += level
+            depth += 1
+    return sorted(found, key=lambda path: path.split(os.sep))
 
+def write_readme(main_file, content, current):
+    '''Write the generated file, only touching it if its contents changed'''
+    if content == current:
+        print(f'README file is up to date: {main_file}')
+        return
     with open(main_file, 'w') as f:
-        f.write(''.join(main_doc))
+        f.write(content)
     print(f'Successfully generated README file: {main_file}')
 
+def save_cache(path, cache, new_cache):
+    '''Save the summary cache if it changed'''
+    if path and new_cache != cache:
+        with open(path, 'w') as f:
+            json.dump(new_cache, f)
 
-if __name__ == '__main__':
-    parser = argparse.ArgumentParser(description='Generate a README.md file with summaries of READMEs in sub-directories')
+def get_cache_file(args):
+    return None if args.nocache else (args.cache or os.path.join(args.repodir, '.generate_readme_cache.json'))
+
+def generate(args):
+    '''Generate a README.md file'''
+    cache_file = get_cache_file(args)
+    cache, new_cache = load_cache(cache_file), {}
+
+    main_file = os.path.join(args.repodir, args.filename)
+    current, main_doc = get_header(main_file)
+    content = render(args, main_doc, list_subdirs(args), cache, new_cache)
+
+    save_cache(cache_file, cache, new_cache)
+    write_readme(main_file, content, current)
+
+def stat_key(path):
+    '''Get the (mtime, size) of a file, or None if it does not exist'''
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    return st.st_mtime_ns, st.st_size
+
+def scan(args, previous):
+    '''Take a snapshot of the root directory using only stat calls.
+    Directories are only listed again if the mtime of one of them changed, i.e. sub-directories were added, removed
+    or renamed.
+    '''
+    dirs = None
+    if previous:
+        dirs = {path: stat_key(os.path.join(args.repodir, path)) for path in previous['dirs']}
+    if previous and dirs == previous['dirs']:
+        names = previous['names']
+    else:
+        names = list_subdirs(args)
+        watched = [''] + (names if args.recursive else [])
+        dirs = {path: stat_key(os.path.join(args.repodir, path)) for path in watched}
+    subfiles = {name: stat_key(os.path.join(args.repodir, name, args.subfilename)) for name in names if not name.startswith('.')}
+    return {
+        'dirs': dirs,
+        'names': names,
+        'subfiles': subfiles,
+        'main': stat_key(os.path.join(args.repodir, args.filename))
+    }
+
+def watch(args):
+    '''Poll the root directory for changes to READMEs, regenerating the file once a burst of changes has settled'''
+    cache_file = get_cache_file(args)
+    cache = load_cache(cache_file)
+    main_file = os.path.join(args.repodir, args.filename)
+    current, main_doc = get_header(main_file)
+
+    snapshot, changed_at = None, time.monotonic()
+    print(f'Watching {args.repodir} for changes, press Ctrl-C to stop')
+    try:
+        while True:
+            new_snapshot = scan(args, snapshot)
+            if snapshot is not None and new_snapshot != snapshot:
+                # The generated file was edited by hand, pick up its new title and summary
+                if new_snapshot['main'] != snapshot['main']:
+                    current, main_doc = get_header(main_file)
+                changed_at = time.monotonic()
+            snapshot = new_snapshot
+
+            # Regenerate once no more changes have been seen for the debounce period
+            if changed_at is not None and time.monotonic() - changed_at >= args.debounce:
+                changed_at = None
+                # Only READMEs whose stat changed are re-parsed, the rest come from the cache
+                new_cache = {}
+                content = render(args, main_doc, snapshot['names'], cache, new_cache)
+                save_cache(cache_file, cache, new_cache)
+                cache = new_cache
+                write_readme(main_file, content, current)
+                current = content
+                snapshot['main'] = stat_key(main_file)
+            time.sleep(args.interval)
+    except KeyboardInterrupt:
+        pass
+
+def get_parser(prog=None):
+    parser = argparse.ArgumentParser(prog=prog, description='Generate a README.md file with summaries of READMEs in sub-directories')
     parser.add_argument('--rootdir', '-d', help='The root directory to generate the file in', required=True, dest='repodir')
     parser.add_argument('--filename', '-f', default='README.md', help='Name of file to generate')
     parser.add_argument('--subfilename', '-s', default='README.md', help='Name of file in subdirectories to summarise')
     parser.add_argument('--index', '-i', default=False, action='store_true', help='Generate an index of all files in subdirectory')
     parser.add_argument('--no-summary', '-n', dest='nosummary', default=False, action='store_true', help="Don't include a summary of READMEs from sub-directories")
+    parser.add_argument('--cache', '-c', help='File to cache summaries of READMEs in (default: ROOTDIR/.generate_readme_cache.json)')
+    parser.add_argument('--no-cache', dest='nocache', default=False, action='store_true', help="Don't cache summaries of READMEs")
+    parser.add_argument('--watch', '-w', default=False, action='store_true', help='Keep running, regenerating the file whenever a README in a sub-directory changes')
+    parser.add_argument('--interval', type=float, default=1.0, help='Seconds between polls of the root directory in watch mode')
+    parser.add_argument('--debounce', type=float, default=0.5, help='Seconds to wait for changes to settle before regenerating in watch mode')
+    parser.add_argument('--recursive', '-R', default=False, action='store_true', help='Summarise READMEs in nested sub-directories too')
+    parser.add_argument('--max-depth', type=int, default=None, help='Maximum depth of sub-directories to summarise in recursive mode')
+    parser.add_argument('--ignore', action='append', default=[], metavar='PATTERN', help='Glob pattern of sub-directories to ignore, can be given multiple times')
+    parser.add_argument('--threads', '-t', type=int, default=8, help='Number of threads used to scan directories and read READMEs')
+    return parser
+
+def main(argv=None, prog=None):
+    parser = get_parser(prog)
+    args = parser.parse_args(argv)
+    if args.watch:
+        watch(args)
+    else:
+        generate(args)
 
-    args = parser.parse_args()
-    generate(args)
 
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,119 @@
+'''Load test uploading worklogs, by replaying a synthetic timesheet through log_to_jira against a mock JIRA server'''
+import argparse
+import contextlib
+import json
+import os
+import random
+import threading
+import time
+from datetime import date, timedelta
+
+from mock_jira import MockJira
+from timesheet import connect, get_project_regex, log_to_jira, parse_timesheet
+
+def generate_timesheet(entries, issues, project='BUG', per_day=8, seed=0):
+    '''Generate the lines of a timesheet with entries half hour entries, per_day a day, spread over issues issues'''
+    rand = random.Random(seed)
+    day = date(2020, 1, 1)
+    lines = ['# Synthetic timesheet\n']
+    for i in range(entries):
+        if i % per_day == 0:
+            lines.append(f'\n# {day.strftime("%d/%m/%Y")}\n\n')
+            day += timedelta(days=1)
+        start = 9 * 60 + (i % per_day) * 30
+        lines.append(f'{start // 60:02d}:{start % 60:02d} - {(start + 30) // 60:02d}:{(start + 30) % 60:02d} - Work on {project}-{rand.randint(1, issues)}\n')
+    return lines
+
+def percentile(values, p):
+    '''Get the pth percentile of values, interpolating between the closest ranks'''
+    values = sorted(values)
+    if not values:
+        return 0.0
+    rank = (len(values) - 1) * p / 100
+    low = int(rank)
+    high = min(low + 1, len(values) - 1)
+    return values[low] + (values[high] - values[low]) * (rank - low)
+
+def run(to_log, jira_url, workers, retries):
+    '''Upload to_log, timing every request made. Returns the wall time and the latency of each request in seconds'''
+    jira = connect(jira_url, 'benchmark', 'benchmark', workers)
+    latencies = []
+    lock = threading.Lock()
+    def record(response, *args, **kwargs):
+        with lock:
+            latencies.append(response.elapsed.total_seconds())
+    jira._session.hooks['response'].append(record)
+
+    start = time.perf_counter()
+    # Silence the line printed for every worklog uploaded
+    with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+        skipped, failed = log_to_jira(to_log, jira_url, None, None, workers, retries, jira=jira)
+    wall = time.perf_counter() - start
+    return wall, latencies, skipped, failed
+
+def benchmark(args):
+    lines = generate_timesheet(args.entries, args.issues, seed=args.seed)
+    to_log = parse_timesheet(lines, get_project_regex(['BUG']), {})
+    worklogs = sum(len(wls) for wls in to_log.values())
+
+    results = []
+    for workers in args.workers:
+        server = None
+        jira_url = args.jira_url
+        if not jira_url:
+            server = MockJira(
+                ('127.0.0.1', 0), args.latency, args.jitter, args.error_rate, args.throttle_rate, args.rate_limit,
+                args.retry_after
+            )
+            server.start()
+            jira_url = server.url
+        try:
+            wall, latencies, skipped, failed = run(to_log, jira_url, workers, args.retries)
+        finally:
+            if server:
+                server.stop()
+        result = {
+            'workers': workers,
+            'worklogs': worklogs,
+            'failed': sum(len(errors) for errors in failed.values()),
+            'skipped': sum(len(wls) for wls in skipped.values()),
+            'requests': len(latencies),
+            'wall_s': round(wall, 3),
+            'requests_per_s': round(len(latencies) / wall, 1),
+            'worklogs_per_s': round(worklogs / wall, 1),
+            'p50_ms': round(percentile(latencies, 50) * 1000, 2),
+            'p95_ms': round(percentile(latencies, 95) * 1000, 2),
+        }
+        if server:
+            result['throttled'] = sum(count for (endpoint, status), count in server.stats.items() if status == 429)
+            result['errors'] = sum(count for (endpoint, status), count in server.stats.items() if status >= 500)
+        results.append(result)
+
+    if args.json:
+        print(json.dumps(results, indent=2))
+        return
+    print(f'{args.entries} entries, {worklogs} worklogs over {len(to_log)} issues')
+    columns = ['workers', 'requests', 'wall_s', 'requests_per_s', 'worklogs_per_s', 'p50_ms', 'p95_ms', 'throttled', 'errors', 'failed']
+    print('  '.join(f'{column:>14}' for column in columns))
+    for result in results:
+        print('  '.join(f'{result.get(column, "-"):>14}' for column in columns))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark uploading worklogs from a synthetic timesheet to a mock JIRA server')
+    parser.add_argument('--entries', type=int, default=2000, help='Number of timesheet entries to generate')
+    parser.add_argument('--issues', type=int, default=200, help='Number of distinct issues to spread the entries over')
+    parser.add_argument('--seed', type=int, default=0, help='Seed for generating the timesheet')
+    parser.add_argument('--workers', type=int, nargs='+', default=[1, 4, 8], help='Numbers of concurrent upload workers to benchmark')
+    parser.add_argument('--retries', type=int, default=5, help='Number of times to retry rate limited or failed requests')
+    parser.add_argument('--jira-url', help='Benchmark against an already running (mock) JIRA instead of starting one')
+    parser.add_argument('--latency', type=float, default=0.005, help='Seconds the mock server delays each request by')
+    parser.add_argument('--jitter', type=float, default=0.0, help='Maximum seconds to randomly add to or take from the latency')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='Fraction of requests the mock server fails with a 503')
+    parser.add_argument('--throttle-rate', type=float, default=0.0, help='Fraction of requests the mock server rejects with a 429')
+    parser.add_argument('--rate-limit', type=float, default=None, help='Requests per second the mock server allows before sending 429s')
+    parser.add_argument('--retry-after', type=int, default=0, help='Seconds the mock server sends in the Retry-After header')
+    parser.add_argument('--json', default=False, action='store_true', help='Print the results as JSON')
+
+    args = parser.parse_args()
+    benchmark(args)
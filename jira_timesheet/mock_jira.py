@@ -0,0 +1,185 @@
+'''A local stand-in for the JIRA REST API endpoints used by timesheet.py, to test and load test uploads offline.
+Latency, server errors and 429 throttling can be injected into the issue, search and worklog endpoints.
+'''
+import argparse
+import json
+import random
+import re
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+issue_rgx = re.compile(r'[A-Z][A-Z0-9_]*-[0-9]+')
+issue_path_rgx = re.compile(r'^/rest/api/2/issue/([^/]+)(/worklog)?/?$')
+
+class MockJira(ThreadingHTTPServer):
+    '''Serve a mock JIRA on (host, port), port 0 picks a free port.
+    Every issue exists unless its key is in missing. Worklogs posted are kept in worklogs, {issue key: [worklog]}, and
+    the number of responses for each endpoint and status in stats, {(endpoint, status): count}.
+    '''
+    daemon_threads = True
+
+    def __init__(self, address, latency=0.0, jitter=0.0, error_rate=0.0, throttle_rate=0.0, rate_limit=None, retry_after=0, missing=()):
+        super().__init__(address, MockJiraHandler)
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.throttle_rate = throttle_rate
+        self.rate_limit = rate_limit
+        self.retry_after = retry_after
+        self.missing = set(missing)
+        self.worklogs = {}
+        self.stats = {}
+        self.lock = threading.Lock()
+        self.tokens = rate_limit or 0
+        self.refilled_at = time.monotonic()
+
+    @property
+    def url(self):
+        host, port = self.server_address[:2]
+        return f'http://{host}:{port}'
+
+    def start(self):
+        '''Serve requests in a background thread'''
+        thread = threading.Thread(target=self.serve_forever, daemon=True)
+        thread.start()
+        return thread
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+    def throttled(self):
+        '''Check if a request should be rejected with a 429, either at random or because it is over the rate limit'''
+        if random.random() < self.throttle_rate:
+            return True
+        if not self.rate_limit:
+            return False
+        # Token bucket which holds up to a second of requests
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.rate_limit, self.tokens + (now - self.refilled_at) * self.rate_limit)
+            self.refilled_at = now
+            if self.tokens < 1:
+                return True
+            self.tokens -= 1
+            return False
+
+    def count(self, endpoint, status):
+        with self.lock:
+            self.stats[(endpoint, status)] = self.stats.get((endpoint, status), 0) + 1
+
+    def add_worklog(self, issue, worklog):
+        with self.lock:
+            worklog = dict(worklog, id=str(sum(len(wls) for wls in self.worklogs.values()) + 1))
+            self.worklogs.setdefault(issue, []).append(worklog)
+        return worklog
+
+class MockJiraHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    # Headers and body are written separately, don't let Nagle's algorithm hold the body back
+    disable_nagle_algorithm = True
+
+    def log_message(self, format, *args):
+        pass
+
+    def send_json(self, endpoint, status, body, headers=None):
+        data = json.dumps(body).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(data)
+        self.server.count(endpoint, status)
+
+    def inject_faults(self, endpoint):
+        '''Sleep for the configured latency, then send an injected error if there should be one.
+        Returns True if a response was sent.
+        '''
+        server = self.server
+        delay = server.latency + random.uniform(-server.jitter, server.jitter)
+        if delay > 0:
+            time.sleep(delay)
+        if server.throttled():
+            self.send_json(endpoint, 429, {'errorMessages': ['Rate limit exceeded']}, {'Retry-After': str(server.retry_after)})
+            return True
+        if random.random() < server.error_rate:
+            self.send_json(endpoint, 503, {'errorMessages': ['Service unavailable']})
+            return True
+        return False
+
+    def issue(self, key):
+        return {'id': key.rsplit('-', 1)[1], 'key': key, 'self': f'{self.server.url}/rest/api/2/issue/{key}', 'fields': {}}
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        path = url.path.rstrip('/')
+        if path == '/rest/api/2/serverInfo':
+            return self.send_json('serverInfo', 200, {'baseUrl': self.server.url, 'version': '8.0.0', 'versionNumbers': [8, 0, 0], 'deploymentType': 'Server'})
+        if path == '/rest/auth/1/session':
+            return self.send_json('session', 200, {'name': 'mock', 'self': self.server.url})
+        if path == '/rest/api/2/field':
+            return self.send_json('field', 200, [{'id': 'summary', 'name': 'Summary', 'custom': False, 'schema': {'type': 'string'}}])
+        if path == '/rest/api/2/search':
+            if self.inject_faults('search'):
+                return
+            jql = parse_qs(url.query).get('jql', [''])[0]
+            keys = [key for key in dict.fromkeys(issue_rgx.findall(jql)) if key not in self.server.missing]
+            return self.send_json('search', 200, {'startAt': 0, 'maxResults': len(keys), 'total': len(keys), 'issues': [self.issue(key) for key in keys]})
+        match = issue_path_rgx.match(path)
+        if match and not match.group(2):
+            if self.inject_faults('issue'):
+                return
+            if match.group(1) in self.server.missing:
+                return self.send_json('issue', 404, {'errorMessages': ['Issue Does Not Exist']})
+            return self.send_json('issue', 200, self.issue(match.group(1)))
+        self.send_json('unknown', 404, {'errorMessages': [f'Not found: {path}']})
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        path = urlparse(self.path).path.rstrip('/')
+        if path == '/rest/auth/1/session':
+            return self.send_json('session', 200, {'session': {'name': 'JSESSIONID', 'value': 'mock'}})
+        match = issue_path_rgx.match(path)
+        if match and match.group(2):
+            if self.inject_faults('worklog'):
+                return
+            if match.group(1) in self.server.missing:
+                return self.send_json('worklog', 404, {'errorMessages': ['Issue Does Not Exist']})
+            worklog = self.server.add_worklog(match.group(1), json.loads(body or b'{}'))
+            return self.send_json('worklog', 201, dict(worklog, self=f'{self.server.url}{path}/{worklog["id"]}'))
+        self.send_json('unknown', 404, {'errorMessages': [f'Not found: {path}']})
+
+def print_stats(server):
+    for (endpoint, status), count in sorted(server.stats.items()):
+        print(f'{endpoint:<12} {status}  {count}')
+    print(f'worklogs     {sum(len(wls) for wls in server.worklogs.values())}')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Run a mock JIRA server to test uploading worklogs against')
+    parser.add_argument('--host', default='127.0.0.1', help='Address to listen on')
+    parser.add_argument('--port', type=int, default=8080, help='Port to listen on')
+    parser.add_argument('--latency', type=float, default=0.0, help='Seconds to delay each issue, search and worklog request by')
+    parser.add_argument('--jitter', type=float, default=0.0, help='Maximum seconds to randomly add to or take from the latency')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='Fraction of requests to fail with a 503')
+    parser.add_argument('--throttle-rate', type=float, default=0.0, help='Fraction of requests to reject with a 429')
+    parser.add_argument('--rate-limit', type=float, default=None, help='Requests per second to allow before rejecting requests with a 429')
+    parser.add_argument('--retry-after', type=int, default=0, help='Seconds sent in the Retry-After header of 429 responses')
+    parser.add_argument('--missing', nargs='+', default=[], metavar='ISSUE', help='Issue keys which should not exist')
+
+    args = parser.parse_args()
+    server = MockJira(
+        (args.host, args.port), args.latency, args.jitter, args.error_rate, args.throttle_rate, args.rate_limit,
+        args.retry_after, args.missing
+    )
+    print(f'Mock JIRA listening on {server.url}, press Ctrl-C to stop')
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    server.server_close()
+    print_stats(server)
@@ -1,13 +1,24 @@
 import argparse
+import csv
+import hashlib
+import json
+import random
 import re
 import os
+import sqlite3
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from datetime import datetime
-from dateutil import parser as dparser
-from jira import JIRA
 from pprint import pprint
 
 date_rgx = re.compile(r'[0-9]{1,2}/[0-9]{1,2}/[0-9]{2,4}') #TODO: support other formats
 entry_rgx = re.compile(r'^\s*([0-9]{1,2}:[0-9]{1,2}[\s-]*[0-9]{1,2}:[0-9]{1,2})[\s-]*(.*)$')
+time_rgx = re.compile(r'^([0-9]{1,2}):([0-9]{1,2})$')
+retry_statuses = [429, 502, 503, 504] # rate limited or server temporarily unavailable
+rejected_statuses = [429, 503] # the request was rejected without being processed, so it is safe to send again
+journal_lock = threading.Lock()
 
 def get_project_regex(projects):
     project_string = f'(?:{"|".join(projects)})'
@@ -19,125 +30,428 @@ def print_summary(data):
         for wl in wls:
             print(f'    * {wl.get("dateStarted")} - {wl.get("timeSpent")}: {wl.get("comment")}')
 
-def log_to_jira(data, jira_url, username, password):
-    jira = JIRA(options={"server": jira_url, "verify": False}, auth=(username, password))
-
-    skipped = {}
-    for issue, wls in to_log.items():
-        if jira.issue(issue):
-            for wl in wls:
-                jira.add_worklog(
-                    issue,
-                    timeSpent=wl.get('timeSpent'),
-                    started=wl.get('dateStarted'),
-                    comment=wl.get('comment')
-                )
-                print(f'Updated {issue}: {wl.get("timeSpent")}')
-        else:
-            skipped[issue] = wls
+def connection_not_established(e):
+    '''Whether a requests exception was raised before a connection was made, so the request was never sent'''
+    import requests
+    from urllib3.exceptions import NewConnectionError
+    if isinstance(e, requests.exceptions.ConnectTimeout):
+        return True
+    reason = getattr(e.args[0], 'reason', None) if e.args else None
+    return isinstance(e, requests.exceptions.ConnectionError) and isinstance(reason, NewConnectionError)
+
+def with_retries(func, *args, retries=5, backoff=1.0, idempotent=True, **kwargs):
+    '''Call a JIRA API method, retrying with exponential backoff if rate limited, the server is unavailable or the
+    connection fails. The Retry-After header of the response is honoured if present.
+    Calls which aren't idempotent (e.g. adding a worklog) are only retried if the request can't have been processed:
+    if it was rate limited or rejected with a 503, or the connection couldn't be established.
+    '''
+    import requests
+    from jira import JIRAError
+    for attempt in range(retries + 1):
+        try:
+            return func(*args, **kwargs)
+        except (requests.exceptions.ConnectionError, requests.exceptions.Timeout) as e:
+            if attempt == retries or not (idempotent or connection_not_established(e)):
+                raise
+            delay = backoff * 2 ** attempt
+        except JIRAError as e:
+            if e.status_code not in (retry_statuses if idempotent else rejected_statuses) or attempt == retries:
+                raise
+            delay = backoff * 2 ** attempt
+            retry_after = e.response.headers.get('Retry-After') if e.response is not None else None
+            if retry_after and retry_after.isdigit():
+                delay = max(delay, int(retry_after))
+        time.sleep(delay + random.uniform(0, backoff))
+
+def load_issue_cache(path):
+    '''Load the cache of known valid issue keys, {jira url: {issue key: time validated}}'''
+    if path and os.path.isfile(path):
+        with open(path, 'r') as f:
+            return json.load(f)
+    return {}
+
+def save_issue_cache(path, cache):
+    os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+    with open(path, 'w') as f:
+        json.dump(cache, f)
+
+def validate_issues(jira, jira_url, issues, cache_file=None, ttl=86400, retries=5, batch_size=100):
+    '''Get the set of issues which exist, searching for the keys not already known to be valid in batches.
+    Issues found are cached for ttl seconds, so repeat runs over the same issues make no requests.
+    '''
+    cache = load_issue_cache(cache_file)
+    known = cache.setdefault(jira_url, {})
+    now = time.time()
+    valid = {issue for issue in issues if now - known.get(issue, 0) < ttl}
+    unknown = [issue for issue in issues if issue not in valid]
+    for i in range(0, len(unknown), batch_size):
+        batch = unknown[i:i + batch_size]
+        # Don't validate the query, so keys which don't exist are ignored instead of failing the search
+        found = with_retries(
+            jira.search_issues,
+            f'key in ({",".join(batch)})',
+            maxResults=len(batch),
+            fields='key',
+            validate_query=False,
+            retries=retries
+        )
+        for result in found:
+            if result.key in batch:
+                valid.add(result.key)
+                known[result.key] = now
+    if cache_file and unknown:
+        save_issue_cache(cache_file, cache)
+    return valid
+
+def open_journal(path):
+    '''Open the journal of uploaded worklogs, shared between upload threads'''
+    os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+    journal = sqlite3.connect(path, check_same_thread=False)
+    journal.execute('''
+        CREATE TABLE IF NOT EXISTS worklogs (
+            jira_url TEXT,
+            issue TEXT,
+            date TEXT,
+            time_range TEXT,
+            comment_hash TEXT,
+            worklog_id TEXT,
+            logged_at TEXT,
+            PRIMARY KEY (jira_url, issue, date, time_range, comment_hash)
+        )
+    ''')
+    return journal
+
+def journal_key(jira_url, issue, wl):
+    '''Identify a worklog by its issue, date, time range and comment'''
+    comment_hash = hashlib.sha1((wl.get('comment') or '').encode('utf-8')).hexdigest()
+    return (jira_url, issue, wl.get('dateStarted').isoformat(), wl.get('timeRange'), comment_hash)
+
+def filter_logged(journal, jira_url, data):
+    '''Remove worklogs which were already uploaded according to the journal'''
+    pending = {}
+    for issue, wls in data.items():
+        for wl in wls:
+            logged = journal.execute(
+                'SELECT 1 FROM worklogs WHERE jira_url = ? AND issue = ? AND date = ? AND time_range = ? AND comment_hash = ?',
+                journal_key(jira_url, issue, wl)
+            ).fetchone()
+            if not logged:
+                pending.setdefault(issue, []).append(wl)
+    return pending
+
+def record_worklog(journal, jira_url, issue, wl, worklog_id):
+    '''Record an uploaded worklog in the journal, committing straight away so it survives a crash'''
+    with journal_lock, journal:
+        journal.execute(
+            'INSERT OR REPLACE INTO worklogs VALUES (?, ?, ?, ?, ?, ?, ?)',
+            journal_key(jira_url, issue, wl) + (str(worklog_id), datetime.now().isoformat())
+        )
+
+def log_issue(jira, issue, wls, retries=5, journal=None, jira_url=None):
+    '''Log the worklogs of an issue, returning a list of (worklog, error) for those that failed'''
+    failed = []
+    for wl in wls:
+        try:
+            worklog = with_retries(
+                jira.add_worklog,
+                issue,
+                timeSpent=wl.get('timeSpent'),
+                started=wl.get('dateStarted'),
+                comment=wl.get('comment'),
+                retries=retries,
+                # A worklog sent again after a lost response would be added twice
+                idempotent=False
+            )
+        except Exception as e:
+            # Any error, e.g. a connection which failed on every retry, only fails this worklog instead of the whole run
+            failed.append((wl, e))
+            continue
+        if journal:
+            # A coalesced worklog is journaled as the timesheet entries it was made from
+            for source in wl.get('sources', [wl]):
+                record_worklog(journal, jira_url, issue, source, worklog.id)
+        print(f'Updated {issue}: {wl.get("timeSpent")}')
+    return failed
+
+def connect(jira_url, username, password, workers=1):
+    '''Connect to JIRA with a connection pool large enough for workers concurrent uploads'''
+    from jira import JIRA
+    from requests.adapters import HTTPAdapter
+    jira = JIRA(options={"server": jira_url, "verify": False}, auth=(username, password), max_retries=0)
+    adapter = HTTPAdapter(pool_connections=workers, pool_maxsize=workers)
+    jira._session.mount('https://', adapter)
+    jira._session.mount('http://', adapter)
+    return jira
+
+def log_to_jira(data, jira_url, username, password, workers=1, retries=5, cache_file=None, cache_ttl=86400, journal=None, jira=None):
+    '''Log worklogs to JIRA, uploading up to workers issues concurrently over a shared connection pool.
+    Uploaded worklogs are recorded in the journal if one is given. An existing client made by connect can be passed as jira.
+    '''
+    if jira is None:
+        jira = connect(jira_url, username, password, workers)
+
+    valid = validate_issues(jira, jira_url, list(data), cache_file, cache_ttl, retries)
+    skipped = {issue: wls for issue, wls in data.items() if issue not in valid}
+    failed = {}
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = {executor.submit(log_issue, jira, issue, wls, retries, journal, jira_url): issue for issue, wls in data.items() if issue in valid}
+        for future in as_completed(futures):
+            errors = future.result()
+            if errors:
+                failed[futures[future]] = errors
     if skipped:
         print('WARNING: The following issues were skipped:')
         print_summary(skipped)
+    if failed:
+        print('ERROR: The following worklogs failed to be logged:')
+        for issue, errors in failed.items():
+            print(f'{issue}:')
+            for wl, e in errors:
+                error = f'{e.status_code}: {e.text}' if hasattr(e, 'status_code') else f'{type(e).__name__}: {e}'
+                print(f'    * {wl.get("dateStarted")} - {wl.get("timeSpent")}: {wl.get("comment")} ({error})')
+    return skipped, failed
 
-def on_run(a):
-    # Check timesheet file exists
-    if not os.path.exists(a.file):
-        raise Exception(f'timesheet file does not exists: {a.file}')
+def parse_time(text):
+    '''Parse a time of day as seconds since midnight, with a fast path for HH:MM'''
+    match = time_rgx.match(text)
+    if match:
+        return int(match.group(1)) * 3600 + int(match.group(2)) * 60
+    from dateutil import parser as dparser
+    parsed = dparser.parse(text)
+    return parsed.hour * 3600 + parsed.minute * 60 + parsed.second
 
-    if not a.projects:
-        raise Exception('at least one project must be specified')
+def format_time_spent(total_seconds):
+    '''Format a duration in seconds as a JIRA time spent string e.g. 1h 30m'''
+    m, s = divmod(total_seconds, 60)
+    h, m = divmod(m, 60)
 
-    to_log = {}
+    time_spent = ""
+    if h and m:
+        time_spent = f'{h}h {m}m'
+    elif m:
+        time_spent = f'{m}m'
+    elif h:
+        time_spent = f'{h}h'
+    return time_spent
 
-    with open(a.file, 'r') as f:
-        skip = False
-        current_date = None
-        for idx, line in enumerate(f):
-            # Search for a line with a date
-            date = re.search(date_rgx, line)
-            if date:
-                # Check if already logged
-                if '@logged' in line:
+def parse_timesheet(lines, project_rgx, to_log):
+    '''Parse the lines of a timesheet, adding a worklog to to_log for each issue mentioned in an entry'''
+    skip = False
+    current_date = None
+    for idx, line in enumerate(lines):
+        # Search for a line with a date
+        date = date_rgx.search(line)
+        if date:
+            # Check if already logged
+            if '@logged' in line:
+                skip = True
+            else:
+                try:
+                    current_date = datetime.strptime(date.group(), '%d/%m/%Y')
+                    skip = False
+                except ValueError:
+                    print(f'WARNING: Could not parse date - {current_date}, skipping entry', file=sys.stderr)
+                    current_date = None
                     skip = True
+        elif current_date and not skip:
+            # Check if entry contains JIRA issue
+            issues = project_rgx.findall(line)
+            if issues:
+                # Check if valid entry for date
+                parsed_entry = entry_rgx.match(line)
+                if not parsed_entry:
+                    print(f'WARNING: Skipping entry as it does not match format: {line}', file=sys.stderr)
+                    continue
+                if len(parsed_entry.groups()) != 2:
+                    print(f'WARNING: Could not parse entry on line {idx}: {line}', file=sys.stderr)
                 else:
-                    try:
-                        current_date = datetime.strptime(date.group(), '%d/%m/%Y')
-                        skip = False
-                    except ValueError:
-                        print(f'WARNING: Could not parse date - {current_date}, skipping entry')
-                        current_date = None
-                        skip = True
-            elif current_date and not skip:
-                # Check if entry contains JIRA issue
-                project_rgx = get_project_regex(a.projects)
-                issues = re.findall(project_rgx, line)
-                if issues:
-                    # Check if valid entry for date
-                    parsed_entry = re.match(entry_rgx, line)
-                    if not parsed_entry:
-                        print(f'WARNING: Skipping entry as it does not match format: {line}')
-                        continue
-                    if len(parsed_entry.groups()) != 2:
-                        print(f'WARNING: Could not parse entry on line {idx}: {line}')
+                    parsed_entry = parsed_entry.groups()
+                    start, end = None, None
+                    if '-' in parsed_entry[0]:
+                        start, end = parsed_entry[0].split('-')
                     else:
-                        parsed_entry = parsed_entry.groups()
-                        start, end = None, None
-                        if '-' in parsed_entry[0]:
-                            start, end = parsed_entry[0].split('-')
-                        else:
-                            start, end = parsed_entry.split()
-                        if start and end:
-                            start = dparser.parse(start.strip())
-                            end = dparser.parse(end.strip())
-                            delta = end - start
-
-                            total_seconds = delta.seconds
-                            if len(issues) > 1:
-                                # Divide the time equally between issues if multiple issues mentioned in same entry
-                                total_seconds = delta.seconds/len(issues)
-                            
-                            m, s = divmod(total_seconds, 60)
-                            h, m = divmod(m, 60)
-
-                            if h >= 12:
-                                h = h - 12 # handle 12h/24h
-
-                            time_spent = ""
-                            if h and m:
-                                time_spent = f'{h}h {m}m'
-                            elif m:
-                                time_spent = f'{m}m'
-                            elif h:
-                                time_spent = f'{h}h'
-
-                            for issue in issues:
-                                if issue not in to_log:
-                                    to_log[issue] = []
-                                to_log[issue].append({
-                                    "timeSpent": time_spent,
-                                    "dateStarted": current_date,
-                                    "comment": parsed_entry[1]
-                                })
-        
+                        start, end = parsed_entry[0].split()
+                    if start and end:
+                        # Same as the seconds of the timedelta between the two times, wrapping past midnight
+                        seconds = (parse_time(end.strip()) - parse_time(start.strip())) % 86400
+
+                        total_seconds = seconds
+                        if len(issues) > 1:
+                            # Divide the time equally between issues if multiple issues mentioned in same entry
+                            total_seconds = seconds/len(issues)
+
+                        if total_seconds >= 12 * 3600:
+                            total_seconds -= 12 * 3600 # handle 12h/24h
+
+                        time_spent = format_time_spent(total_seconds)
+
+                        for issue in issues:
+                            if issue not in to_log:
+                                to_log[issue] = []
+                            to_log[issue].append({
+                                "timeSpent": time_spent,
+                                "seconds": total_seconds,
+                                "dateStarted": current_date,
+                                "timeRange": f'{start.strip()}-{end.strip()}',
+                                "comment": parsed_entry[1]
+                            })
+    return to_log
+
+def collect_worklogs(files, projects):
+    '''Parse worklogs from timesheet files, one after another (- reads from stdin)'''
+    # Compile the project regex once for all files
+    project_rgx = get_project_regex(projects)
+    to_log = {}
+    for path in files:
+        if path == '-':
+            parse_timesheet(sys.stdin, project_rgx, to_log)
+        else:
+            with open(path, 'r') as f:
+                parse_timesheet(f, project_rgx, to_log)
+    return to_log
+
+def coalesce(data):
+    '''Combine the worklogs of each issue on the same day into a single worklog, joining their comments.
+    The original worklogs are kept in sources, so they can be journaled individually.
+    '''
+    coalesced = {}
+    for issue, wls in data.items():
+        days = {}
+        for wl in wls:
+            day = days.setdefault(wl.get('dateStarted'), {'seconds': 0, 'dateStarted': wl.get('dateStarted'), 'timeRanges': [], 'comments': [], 'sources': []})
+            day['sources'].append(wl)
+            day['seconds'] += wl.get('seconds')
+            day['timeRanges'].append(wl.get('timeRange'))
+            if wl.get('comment') not in day['comments']:
+                day['comments'].append(wl.get('comment'))
+        coalesced[issue] = [{
+            "timeSpent": format_time_spent(day['seconds']),
+            "seconds": day['seconds'],
+            "dateStarted": day['dateStarted'],
+            "timeRange": ','.join(day['timeRanges']),
+            "comment": '; '.join(day['comments']),
+            "sources": day['sources']
+        } for day in days.values()]
+    return coalesced
+
+def report_totals(data, groupings):
+    '''Total the number of worklogs and time spent per issue, project, day and/or week.
+    Returns {grouping: {key: [worklogs, seconds]}}
+    '''
+    keys = {
+        'issue': lambda issue, wl: issue,
+        'project': lambda issue, wl: issue.rsplit('-', 1)[0],
+        'day': lambda issue, wl: wl.get('dateStarted').strftime('%Y-%m-%d'),
+        'week': lambda issue, wl: '{0}-W{1:02d}'.format(*wl.get('dateStarted').isocalendar()),
+    }
+    totals = {grouping: {} for grouping in groupings}
+    for issue, wls in data.items():
+        for wl in wls:
+            for grouping in groupings:
+                total = totals[grouping].setdefault(keys[grouping](issue, wl), [0, 0])
+                total[0] += 1
+                total[1] += wl.get('seconds')
+    return {grouping: dict(sorted(group.items())) for grouping, group in totals.items()}
+
+def print_report(totals, fmt):
+    '''Print report totals as a table, CSV or JSON'''
+    if fmt == 'json':
+        report = {
+            grouping: {key: {'worklogs': count, 'hours': round(seconds / 3600, 2)} for key, (count, seconds) in group.items()}
+            for grouping, group in totals.items()
+        }
+        print(json.dumps(report, indent=2))
+    elif fmt == 'csv':
+        writer = csv.writer(sys.stdout)
+        writer.writerow(['group', 'key', 'worklogs', 'hours'])
+        for grouping, group in totals.items():
+            for key, (count, seconds) in group.items():
+                writer.writerow([grouping, key, count, round(seconds / 3600, 2)])
+    else:
+        for grouping, group in totals.items():
+            width = max([len(grouping)] + [len(key) for key in group])
+            print(f'{grouping.upper():<{width}}  {"WORKLOGS":>8}  {"HOURS":>8}')
+            for key, (count, seconds) in group.items():
+                print(f'{key:<{width}}  {count:>8}  {seconds / 3600:>8.2f}')
+            print()
+
+def on_run(a):
+    # Check timesheet files exist
+    for path in a.file:
+        if path != '-' and not os.path.exists(path):
+            raise Exception(f'timesheet file does not exists: {path}')
+
+    if not a.projects:
+        raise Exception('at least one project must be specified')
+
+    to_log = collect_worklogs(a.file, a.projects)
+
+    if a.report:
+        print_report(report_totals(coalesce(to_log) if a.coalesce else to_log, a.report_by), a.report)
+        return
+
+    if a.parse_only:
+        if a.coalesce:
+            to_log = {issue: [{k: v for k, v in wl.items() if k != 'sources'} for wl in wls] for issue, wls in coalesce(to_log).items()}
+        json.dump(to_log, sys.stdout, default=lambda d: d.isoformat(), indent=2)
+        print()
+        return
+
+    if not (a.username and a.password):
+        raise Exception('--username and --password are required to upload worklogs')
+
+    journal = None
+    if a.journal:
+        # Skip worklogs uploaded by a previous run, so an interrupted upload can simply be resumed.
+        # This is done before coalescing, so entries added to a day which was already logged are uploaded on their own
+        journal = open_journal(a.journal)
+        pending = filter_logged(journal, a.jira_url, to_log)
+        already_logged = sum(len(wls) for wls in to_log.values()) - sum(len(wls) for wls in pending.values())
+        if already_logged:
+            print(f'Skipping {already_logged} worklogs which were already logged')
+        to_log = pending
+        if not to_log:
+            print('Nothing to log')
+            return
+    if a.coalesce:
+        to_log = coalesce(to_log)
+
     print("About to log the following to JIRA:")
     print_summary(to_log)
     while True:
         prompt = input("Do you wish to continue? answer y or n\n")
         if prompt in ['y', 'yes']:
-            log_to_jira(to_log, a.jira_url, a.username, a.password)
+            log_to_jira(to_log, a.jira_url, a.username, a.password, a.workers, a.retries, a.issue_cache, a.issue_cache_ttl, journal)
             break
         elif prompt in ['n', 'no']:
             break
 
-
-if __name__ == '__main__':
-    parser = argparse.ArgumentParser('Upload worklogs to JIRA from a plaintext timesheet file')
-    parser.add_argument('--file', help='Path to timesheet file', required=True)
-    parser.add_argument('--username', help='JIRA Username', required=True)
-    parser.add_argument('--password', help='JIRA Password', required=True)
+def get_parser(prog=None):
+    parser = argparse.ArgumentParser(prog=prog, description='Upload worklogs to JIRA from a plaintext timesheet file')
+    parser.add_argument('--file', nargs='+', help='Paths to timesheet files, - to read from stdin', required=True)
+    parser.add_argument('--username', help='JIRA Username')
+    parser.add_argument('--password', help='JIRA Password')
     parser.add_argument('--jira-url', help='JIRA URL', required=False, default='https://jira.atlassian.com')
     parser.add_argument('--projects', nargs='+', type=str, required=True)
+    parser.add_argument('--parse-only', default=False, action='store_true', help='Print the parsed worklogs as JSON instead of uploading them')
+    parser.add_argument('--coalesce', default=False, action='store_true', help='Combine the worklogs of each issue on the same day into one worklog')
+    parser.add_argument('--report', choices=['table', 'csv', 'json'], help='Print a report of time spent instead of uploading worklogs')
+    parser.add_argument('--report-by', nargs='+', choices=['issue', 'project', 'day', 'week'], default=['issue', 'project', 'day', 'week'], help='Totals to include in the report')
+    parser.add_argument('--journal', default=os.path.join(os.path.expanduser('~'), '.cache', 'jira_timesheet', 'journal.db'), help='SQLite journal of uploaded worklogs, used to skip them on reruns')
+    parser.add_argument('--no-journal', dest='journal', action='store_const', const=None, help="Don't record or skip uploaded worklogs")
+    parser.add_argument('--workers', type=int, default=1, help='Number of issues to upload worklogs for concurrently')
+    parser.add_argument('--retries', type=int, default=5, help='Number of times to retry rate limited or failed requests')
+    parser.add_argument('--issue-cache', default=os.path.join(os.path.expanduser('~'), '.cache', 'jira_timesheet', 'issues.json'), help='File to cache valid issue keys in')
+    parser.add_argument('--issue-cache-ttl', type=int, default=86400, help='Seconds to trust cached issue keys for (default: 1 day)')
 
     parser.set_defaults(func=on_run)
-    args = parser.parse_args()
-    args.func(args)
\ No newline at end of file
+    return parser
+
+def main(argv=None, prog=None):
+    parser = get_parser(prog)
+    args = parser.parse_args(argv)
+    args.func(args)
+
+
+if __name__ == '__main__':
+    main()
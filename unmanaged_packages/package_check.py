@@ -0,0 +1,260 @@
+import json
+import time
+from ansible import constants as C
+from ansible.plugins.callback.default import CallbackModule as DefaultCallbackModule
+
+from package_info import remove_manifest_packages, unmanaged
+
+###################################################################
+## Handle compatibility options to get rid of warnings. Copied from: https://github.com/ansible/ansible/blob/stable-2.9/lib/ansible/plugins/callback/default.py#L46
+
+# These values use ansible.constants for historical reasons, mostly to allow
+# unmodified derivative plugins to work. However, newer options added to the
+# plugin are not also added to ansible.constants, so authors of derivative
+# callback plugins will eventually need to add a reference to the common docs
+# fragment for the 'default' callback plugin
+
+# these are used to provide backwards compat with old plugins that subclass from default
+# but still don't use the new config system and/or fail to document the options
+# TODO: Change the default of check_mode_markers to True in a future release (2.13)
+COMPAT_OPTIONS = (('display_skipped_hosts', C.DISPLAY_SKIPPED_HOSTS),
+                  ('display_ok_hosts', True),
+                  ('show_custom_stats', C.SHOW_CUSTOM_STATS),
+                  ('display_failed_stderr', False),
+                  ('check_mode_markers', False),
+                  ('show_per_host_start', False))
+####################################################################
+
+class CallbackModule(DefaultCallbackModule):
+    '''
+    Prints package information to stdout
+    '''
+
+    CALLBACK_VERSION = 1.0
+    CALLBACK_TYPE = 'stdout'
+    CALLBACK_NAME = 'package_check'
+
+    def __init__(self, jsonl=None, manifest_cache=None, manifest_max_age=86400):
+        # Define an object to to store results of detected package installs by the playbook and manual installs per host
+        # {
+        #     "localhost": {
+        #         "manual" set{'steam', 'vim'}
+        #         "managed": set{'steam'}
+        #     },
+        #     "192.168.1.40": {
+        #         "manual" set{'ntp', 'sshd'}
+        #         "managed": set{'sshd', 'ntp'}
+        #     }
+        # }
+        self.package_info = {}
+        # Each host's result is written to jsonl as soon as its package check completes, along with the timing of every
+        # task, which needs the manifests to remove from its manual packages straight away
+        self.jsonl = jsonl
+        self.manifest_cache = manifest_cache
+        self.manifest_max_age = manifest_max_age
+        self.manifests = {}
+        self.completed = set()
+        # Start times of tasks, {task uuid: time} and of tasks per host, {(host, task uuid): time}
+        self.task_started = {}
+        self.host_task_started = {}
+        # Duration of every task run on every host, [(host, task name, seconds)]
+        self.timings = []
+        # for backwards compat with plugins subclassing default, fallback to constants
+        for option, constant in COMPAT_OPTIONS:
+            try:
+                value = self.get_option(option)
+            except (AttributeError, KeyError):
+                value = constant
+            setattr(self, option, value)
+        super(CallbackModule, self).__init__()
+        
+    def emit(self, event):
+        if self.jsonl:
+            self.jsonl.write(json.dumps(event) + '\n')
+            self.jsonl.flush()
+
+    def record_timing(self, result, status):
+        '''Record how long a task took on a host, from when it started on the host if known or else from the task start'''
+        h = result._host.get_name()
+        task = result._task
+        started = self.host_task_started.pop((h, task._uuid), None) or self.task_started.get(task._uuid)
+        duration = time.time() - started if started else 0.0
+        self.timings.append((h, task.get_name(), duration))
+        self.emit({
+            "event": "task",
+            "host": h,
+            "task": task.get_name(),
+            "action": result._task_fields.get('action'),
+            "status": status,
+            "duration": round(duration, 3)
+        })
+
+    def host_completed(self, h):
+        '''Write the result of a host whose package check completed'''
+        if h in self.completed or h not in self.package_info:
+            return
+        self.completed.add(h)
+        info = self.package_info[h]
+        if self.manifest_cache:
+            remove_manifest_packages({h: info}, self.manifest_cache, self.manifest_max_age, self.manifests)
+        self.emit({
+            "event": "host",
+            "host": h,
+            "status": "failed" if info['failed'] else "ok",
+            "unmanaged": sorted(unmanaged(info)) if not info['failed'] else []
+        })
+
+    def slowest(self, top=10):
+        '''Get the hosts with the longest total task time, and the tasks with the longest total time across hosts'''
+        hosts, tasks = {}, {}
+        for h, task, duration in self.timings:
+            hosts[h] = hosts.get(h, 0.0) + duration
+            total, longest, count = tasks.get(task, (0.0, 0.0, 0))
+            tasks[task] = (total + duration, max(longest, duration), count + 1)
+        slowest_hosts = sorted(hosts.items(), key=lambda item: -item[1])[:top]
+        slowest_tasks = sorted(tasks.items(), key=lambda item: -item[1][0])[:top]
+        return slowest_hosts, slowest_tasks
+
+    def finish(self, top=10, show_timing=False):
+        '''Write the results of any hosts which didn't complete the package check, and a summary of the slowest hosts and tasks'''
+        for h in list(self.package_info):
+            # Hosts which never got their manually installed packages only have a partial package list
+            if not self.package_info[h].get('checked'):
+                self.package_info[h]['failed'] = True
+            self.host_completed(h)
+        slowest_hosts, slowest_tasks = self.slowest(top)
+        self.emit({
+            "event": "summary",
+            "slowest_hosts": [{"host": h, "duration": round(duration, 3)} for h, duration in slowest_hosts],
+            "slowest_tasks": [
+                {"task": task, "duration": round(total, 3), "max": round(longest, 3), "hosts": count}
+                for task, (total, longest, count) in slowest_tasks
+            ]
+        })
+        if show_timing:
+            self._display.banner("SLOWEST HOSTS")
+            for h, duration in slowest_hosts:
+                print("  %8.2fs  %s" % (duration, h))
+            self._display.banner("SLOWEST TASKS")
+            for task, (total, longest, count) in slowest_tasks:
+                print("  %8.2fs  (max %.2fs over %d hosts)  %s" % (total, longest, count, task))
+
+    def v2_runner_on_start(self, host, task):
+        self.host_task_started[(host.get_name(), task._uuid)] = time.time()
+
+    def v2_runner_on_ok(self, result):
+        # Print any warnings
+        self._handle_warnings(result._result)
+        h = result._host.get_name()
+        self.record_timing(result, "ok")
+
+        # Filter for package installs
+        if result._task_fields.get('action') == 'apt':
+            # We only care about installs (not uninstalls)
+            if result._task_fields.get('args', {}).get('state') != 'absent':
+                # Add the package name to list of managed packages
+                package_name = result._task_fields.get('args', {}).get('name')
+                if package_name:
+                    # Build up a de-duplicated list of managed packages for each host
+                    # List can be unordered, hence the use of sets
+                    if h not in self.package_info:
+                        self.package_info[h] = {
+                            "manual": set(),
+                            "managed": set(),
+                            "failed": False
+                        }
+                    # Handle multiple packages being installed
+                    if isinstance(package_name, list):
+                        self.package_info[h]["managed"].update(package_name)
+                    # Handle single package installs
+                    elif isinstance(package_name, str):
+                        self.package_info[h]["managed"].add(package_name)
+                else:
+                    print('Got empty package name')
+
+        # Filter for manually installed packages, the Ubuntu manifest packages are removed from them on the controller
+        if result._task_fields.get('name') == 'package_check - get real manually installed packages':
+            facts = result._result.get('ansible_facts', {})
+            if h not in self.package_info:
+                self.package_info[h] = {
+                            "manual": set(),
+                            "managed": set(),
+                            "failed": False
+                        }
+            self.package_info[h]["manual"].update(facts.get('manual_packages', []))
+            self.package_info[h]["release"] = (facts.get('manifest_release'), facts.get('manifest_version'))
+            self.package_info[h]["checked"] = True
+            self.host_completed(h)
+
+        # In fast mode a single task prints the release followed by the manually installed packages
+        if result._task_fields.get('name') == 'package_check - get release and manually installed packages':
+            lines = result._result.get('stdout_lines', [])
+            if h not in self.package_info:
+                self.package_info[h] = {
+                            "manual": set(),
+                            "managed": set(),
+                            "failed": False
+                        }
+            if lines:
+                self.package_info[h]["release"] = tuple(lines[0].split())
+                self.package_info[h]["manual"].update(lines[1:])
+                self.package_info[h]["checked"] = True
+            self.host_completed(h)
+
+    def v2_runner_on_failed(self, result, ignore_errors=False):
+        h = result._host.get_name()
+        self.record_timing(result, "failed")
+        if h not in self.package_info:
+            self.package_info[h] = {
+                    "manual": set(),
+                    "managed": set(),
+                    "failed": True
+            }
+        else:
+            self.package_info[h]["failed"] = True
+        if result._task.get_name().startswith('package_check - '):
+            self.host_completed(h)
+
+        super(CallbackModule, self).v2_runner_on_failed(result)
+
+    def v2_runner_on_unreachable(self, result):
+        h = result._host.get_name()
+        self.record_timing(result, "unreachable")
+        # An unreachable host never runs the rest of its tasks, so its package lists are incomplete
+        if h not in self.package_info:
+            self.package_info[h] = {
+                    "manual": set(),
+                    "managed": set(),
+                    "failed": True
+            }
+        else:
+            self.package_info[h]["failed"] = True
+        if result._task.get_name().startswith('package_check - '):
+            self.host_completed(h)
+
+        super(CallbackModule, self).v2_runner_on_unreachable(result)
+
+    def v2_playbook_on_stats(self, stats):
+        if self._display.verbosity:
+            super(CallbackModule, self).v2_playbook_on_stats(stats)
+
+    def v2_playbook_on_task_start(self, task, is_conditional):
+        self.task_started[task._uuid] = time.time()
+        if self._display.verbosity:
+            super(CallbackModule, self).v2_playbook_on_task_start(task, is_conditional)
+
+    def v2_runner_item_on_ok(self, result):
+        if self._display.verbosity:
+            super(CallbackModule, self).v2_runner_item_on_ok(result)
+
+    def v2_runner_item_on_failed(self, result):
+        h = result._host.get_name()
+        if h not in self.package_info:
+            self.package_info[h] = {
+                    "manual": set(),
+                    "managed": set(),
+                    "failed": True
+            }
+        else:
+            self.package_info[h]["failed"] = True
+        super(CallbackModule, self).v2_runner_item_on_failed(result)
@@ -0,0 +1,195 @@
+'''Helpers shared by unmanaged_packages.py and the package_check callback: fetching Ubuntu manifests, and storing,
+comparing and summarising snapshots of the packages on each host. They don't need ansible to be imported.
+'''
+import sys
+import os
+import json
+import sqlite3
+import time
+
+MANIFEST_URL = 'http://releases.ubuntu.com/releases/{release}/ubuntu-{version}-desktop-amd64.manifest'
+
+def fetch_manifest(release, version, cache_dir, max_age=86400):
+    '''
+    Get the set of packages in the Ubuntu desktop manifest of a release, e.g. ('20.04', '20.04.1').
+    Manifests are cached in cache_dir keyed on the release version. A cached manifest older than max_age seconds is
+    revalidated with a conditional request, and is still used if the request fails (e.g. on an air-gapped controller).
+    Returns None if the manifest can't be fetched and isn't cached.
+    '''
+    import urllib.error
+    import urllib.request
+    url = MANIFEST_URL.format(release=release, version=version)
+    path = os.path.join(cache_dir, os.path.basename(url))
+    meta_path = path + '.json'
+    meta = {}
+    if os.path.isfile(path) and os.path.isfile(meta_path):
+        with open(meta_path, 'r') as f:
+            meta = json.load(f)
+
+    if not meta or time.time() - meta.get('fetched_at', 0) >= max_age:
+        request = urllib.request.Request(url)
+        if meta.get('etag'):
+            request.add_header('If-None-Match', meta['etag'])
+        if meta.get('last_modified'):
+            request.add_header('If-Modified-Since', meta['last_modified'])
+        fetched = False
+        try:
+            with urllib.request.urlopen(request, timeout=30) as response:
+                data = response.read()
+            os.makedirs(cache_dir, exist_ok=True)
+            with open(path, 'wb') as f:
+                f.write(data)
+            meta = {'etag': response.headers.get('ETag'), 'last_modified': response.headers.get('Last-Modified')}
+            fetched = True
+        except urllib.error.HTTPError as e:
+            # Not modified since it was cached
+            fetched = e.code == 304 and bool(meta)
+            if not fetched:
+                print("Failed to fetch Ubuntu manifest %s: %s" % (url, e), file=sys.stderr)
+                if not meta:
+                    return None
+        except (urllib.error.URLError, OSError) as e:
+            print("Failed to fetch Ubuntu manifest %s: %s" % (url, e), file=sys.stderr)
+            if not meta:
+                return None
+        # Only a successful revalidation makes the cached copy fresh, so failures are retried on the next run
+        if fetched:
+            meta['fetched_at'] = time.time()
+            with open(meta_path, 'w') as f:
+                json.dump(meta, f)
+
+    with open(path, 'r') as f:
+        return {line.split('\t')[0].strip() for line in f if line.strip()}
+
+def remove_manifest_packages(package_info, cache_dir, max_age=86400, manifests=None):
+    '''
+    Remove the packages in the Ubuntu manifest of each host's release from its manually installed packages.
+    Each distinct manifest is only fetched once, manifests can be passed to share them between calls.
+    Hosts whose manifest can't be fetched are marked as failed.
+    '''
+    manifests = {} if manifests is None else manifests
+    for hostname, info in package_info.items():
+        release = info.get('release')
+        if info['failed'] or not release:
+            continue
+        if release not in manifests:
+            manifests[release] = fetch_manifest(*release, cache_dir, max_age)
+        if manifests[release] is None:
+            info['failed'] = True
+        else:
+            info['manual'] -= manifests[release]
+
+def open_store(path):
+    '''
+    Open the snapshot store of package sets per host. Host and package names are interned into integer ids, so each
+    snapshot only stores (host id, package id) pairs.
+    '''
+    os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+    store = sqlite3.connect(path)
+    store.executescript('''
+        CREATE TABLE IF NOT EXISTS packages (id INTEGER PRIMARY KEY, name TEXT UNIQUE NOT NULL);
+        CREATE TABLE IF NOT EXISTS hosts (id INTEGER PRIMARY KEY, name TEXT UNIQUE NOT NULL);
+        CREATE TABLE IF NOT EXISTS snapshots (id INTEGER PRIMARY KEY, taken_at TEXT NOT NULL);
+        CREATE TABLE IF NOT EXISTS snapshot_hosts (
+            snapshot_id INTEGER, host_id INTEGER, failed INTEGER,
+            PRIMARY KEY (snapshot_id, host_id)
+        ) WITHOUT ROWID;
+        CREATE TABLE IF NOT EXISTS snapshot_packages (
+            snapshot_id INTEGER, host_id INTEGER, managed INTEGER, package_id INTEGER,
+            PRIMARY KEY (snapshot_id, host_id, managed, package_id)
+        ) WITHOUT ROWID;
+    ''')
+    return store
+
+def intern_names(store, table, names):
+    '''Get the ids of names in the hosts or packages table, adding any names not seen before'''
+    store.executemany('INSERT OR IGNORE INTO %s (name) VALUES (?)' % table, ((name,) for name in names))
+    ids = {}
+    names = list(names)
+    # Stay under the SQLite limit on the number of query parameters
+    for i in range(0, len(names), 500):
+        batch = names[i:i + 500]
+        query = 'SELECT name, id FROM %s WHERE name IN (%s)' % (table, ','.join('?' * len(batch)))
+        ids.update(store.execute(query, batch))
+    return ids
+
+def save_snapshot(store, package_info):
+    '''Save the manual and managed packages of every host as a new snapshot, returning its id'''
+    with store:
+        snapshot_id = store.execute("INSERT INTO snapshots (taken_at) VALUES (datetime('now'))").lastrowid
+        host_ids = intern_names(store, 'hosts', package_info.keys())
+        package_ids = intern_names(store, 'packages', {p for info in package_info.values() for p in info['manual'] | info['managed']})
+        for hostname, info in package_info.items():
+            host_id = host_ids[hostname]
+            store.execute('INSERT INTO snapshot_hosts VALUES (?, ?, ?)', (snapshot_id, host_id, int(info['failed'])))
+            store.executemany(
+                'INSERT INTO snapshot_packages VALUES (?, ?, ?, ?)',
+                [(snapshot_id, host_id, 0, package_ids[p]) for p in info['manual']] +
+                [(snapshot_id, host_id, 1, package_ids[p]) for p in info['managed']]
+            )
+    return snapshot_id
+
+def find_snapshot(store, ref):
+    '''Get the id of a snapshot from its id, or latest for the most recent one. Returns None if there is none'''
+    if ref == 'latest':
+        row = store.execute('SELECT MAX(id) FROM snapshots').fetchone()
+    else:
+        row = store.execute('SELECT id FROM snapshots WHERE id = ?', (ref,)).fetchone()
+    return row[0] if row else None
+
+def load_snapshot(store, snapshot_id, carry_forward=False):
+    '''Load a snapshot in the same form as CallbackModule.package_info.
+    With carry_forward, hosts which failed in the snapshot are loaded from their latest earlier successful snapshot
+    instead, so they can still be diffed against.
+    '''
+    package_info, sources = {}, {}
+    for hostname, host_id, failed in store.execute(
+        'SELECT h.name, h.id, s.failed FROM snapshot_hosts s JOIN hosts h ON h.id = s.host_id WHERE s.snapshot_id = ?', (snapshot_id,)
+    ):
+        source = snapshot_id
+        if failed and carry_forward:
+            source = store.execute(
+                'SELECT MAX(snapshot_id) FROM snapshot_hosts WHERE host_id = ? AND failed = 0 AND snapshot_id < ?', (host_id, snapshot_id)
+            ).fetchone()[0]
+            failed = source is None
+        package_info[hostname] = {"manual": set(), "managed": set(), "failed": bool(failed)}
+        if source is not None:
+            sources.setdefault(source, []).append(host_id)
+    for source, host_ids in sources.items():
+        for hostname, managed, package in store.execute(
+            '''SELECT h.name, s.managed, p.name FROM snapshot_packages s
+               JOIN hosts h ON h.id = s.host_id JOIN packages p ON p.id = s.package_id
+               WHERE s.snapshot_id = ? AND s.host_id IN (%s)''' % ','.join('?' * len(host_ids)), [source] + host_ids
+        ):
+            package_info[hostname]["managed" if managed else "manual"].add(package)
+    return package_info
+
+def unmanaged(info):
+    return info['manual'] - info['managed']
+
+def print_diff(package_info, previous):
+    '''Print only the unmanaged packages added or removed on each host since a previous snapshot'''
+    from ansible.utils.color import stringc
+    for hostname, info in package_info.items():
+        if info['failed']:
+            print("FAILED => %s:" % stringc(hostname, "red"))
+            continue
+        before = unmanaged(previous[hostname]) if hostname in previous and not previous[hostname]['failed'] else set()
+        after = unmanaged(info)
+        if before == after:
+            continue
+        print("CHANGED => %s:" % stringc(hostname, "yellow"))
+        for p in sorted(after - before):
+            print("  + %s" % stringc(p, "green"))
+        for p in sorted(before - after):
+            print("  - %s" % stringc(p, "red"))
+
+def print_aggregates(package_info, top=20):
+    '''Print the packages which are unmanaged on the most hosts'''
+    counts = {}
+    hosts = [info for info in package_info.values() if not info['failed']]
+    for info in hosts:
+        for p in unmanaged(info):
+            counts[p] = counts.get(p, 0) + 1
+    for p, count in sorted(counts.items(), key=lambda item: (-item[1], item[0]))[:top]:
+        print("  %s is unmanaged on %d/%d hosts" % (p, count, len(hosts)))
@@ -1,315 +1,299 @@
 import sys
 import os
+import argparse
 import shutil
+import stat
 from copy import copy
-from ansible import context
-from ansible import constants as C
-from ansible.cli import CLI
-from ansible.cli.playbook import PlaybookCLI
-from ansible.utils.color import stringc
-from ansible.utils.collection_loader import get_collection_name_from_path, set_collection_playbook_paths
-from ansible.module_utils.common.collections import ImmutableDict
-from ansible.module_utils._text import to_bytes
-from ansible.module_utils._text import to_text
-from ansible.playbook.play import Play
-from ansible.executor.playbook_executor import PlaybookExecutor
-from ansible.executor.task_queue_manager import TaskQueueManager
-from ansible.plugins.loader import add_all_plugin_dirs
-from ansible.plugins.loader import callback_loader
-from ansible.plugins.callback.default import CallbackModule as DefaultCallbackModule
-
-###################################################################
-## Handle compatibility options to get rid of warnings. Copied from: https://github.com/ansible/ansible/blob/stable-2.9/lib/ansible/plugins/callback/default.py#L46
-
-# These values use ansible.constants for historical reasons, mostly to allow
-# unmodified derivative plugins to work. However, newer options added to the
-# plugin are not also added to ansible.constants, so authors of derivative
-# callback plugins will eventually need to add a reference to the common docs
-# fragment for the 'default' callback plugin
-
-# these are used to provide backwards compat with old plugins that subclass from default
-# but still don't use the new config system and/or fail to document the options
-# TODO: Change the default of check_mode_markers to True in a future release (2.13)
-COMPAT_OPTIONS = (('display_skipped_hosts', C.DISPLAY_SKIPPED_HOSTS),
-                  ('display_ok_hosts', True),
-                  ('show_custom_stats', C.SHOW_CUSTOM_STATS),
-                  ('display_failed_stderr', False),
-                  ('check_mode_markers', False),
-                  ('show_per_host_start', False))
-####################################################################
-
-class CallbackModule(DefaultCallbackModule):
-    '''
-    Prints package information to stdout
-    '''
 
-    CALLBACK_VERSION = 1.0
-    CALLBACK_TYPE = 'stdout'
-    CALLBACK_NAME = 'package_check'
-
-    def __init__(self):
-        # Define an object to to store results of detected package installs by the playbook and manual installs per host
-        # {
-        #     "localhost": {
-        #         "manual" set{'steam', 'vim'}
-        #         "managed": set{'steam'}
-        #     },
-        #     "192.168.1.40": {
-        #         "manual" set{'ntp', 'sshd'}
-        #         "managed": set{'sshd', 'ntp'}
-        #     }
-        # }
-        self.package_info = {}
-        # for backwards compat with plugins subclassing default, fallback to constants
-        for option, constant in COMPAT_OPTIONS:
-            try:
-                value = self.get_option(option)
-            except (AttributeError, KeyError):
-                value = constant
-            setattr(self, option, value)
-        super(CallbackModule, self).__init__()
-        
-    def v2_runner_on_ok(self, result):
-        # Print any warnings
-        self._handle_warnings(result._result)
-        h = result._host.get_name()
-
-        # Filter for package installs
-        if result._task_fields.get('action') == 'apt':
-            # We only care about installs (not uninstalls)
-            if result._task_fields.get('args', {}).get('state') != 'absent':
-                # Add the package name to list of managed packages
-                package_name = result._task_fields.get('args', {}).get('name')
-                if package_name:
-                    # Build up a de-duplicated list of managed packages for each host
-                    # List can be unordered, hence the use of sets
-                    if h not in self.package_info:
-                        self.package_info[h] = {
-                            "manual": set(),
-                            "managed": set(),
-                            "failed": False
-                        }
-                    # Handle multiple packages being installed
-                    if isinstance(package_name, list):
-                        self.package_info[h]["managed"].update(package_name)
-                    # Handle single package installs
-                    elif isinstance(package_name, str):
-                        self.package_info[h]["managed"].add(package_name)
-                else:
-                    print('Got empty package name')
-
-        # Filter for package installs
-        if result._task_fields.get('name') == 'package_check - get real manually installed packages':
-            packages = result._task_fields.get('args', {}).get('manual_packages', [])
-            if h not in self.package_info:
-                self.package_info[h] = {
-                            "manual": set(),
-                            "managed": set(),
-                            "failed": False
-                        }
-            self.package_info[h]["manual"].update(packages)
-
-    def v2_runner_on_failed(self, result, ignore_errors=False):
-        h = result._host.get_name()
-        if h not in self.package_info:
-            self.package_info[h] = {
-                    "manual": set(),
-                    "managed": set(),
-                    "failed": True
+from package_info import find_snapshot, load_snapshot, open_store, print_aggregates, print_diff, remove_manifest_packages, save_snapshot
+
+def snapshot_id(value):
+    '''Parse a snapshot id argument'''
+    if not value.isdigit() or int(value) < 1:
+        raise argparse.ArgumentTypeError("invalid snapshot id: '%s'" % value)
+    return int(value)
+
+def get_parser(prog=None):
+    '''Get the parser for our own options, which are taken out before the rest are passed on to ansible-playbook'''
+    parser = argparse.ArgumentParser(
+        prog=prog,
+        description='Report packages installed on hosts which are not installed by a playbook',
+        epilog='All other arguments are passed on to ansible-playbook, see ansible-playbook --help',
+        add_help=False,
+        allow_abbrev=False
+    )
+    parser.add_argument('--help', '-h', action='store_true', default=False, help='show this help message and exit')
+    parser.add_argument('--manifest-cache', default=os.path.join(os.path.expanduser('~'), '.cache', 'unmanaged_packages', 'manifests'), help='Directory to cache Ubuntu manifests in')
+    parser.add_argument('--manifest-max-age', type=int, default=86400, help='Seconds before a cached manifest is revalidated (default: 1 day)')
+    parser.add_argument('--fast', action='store_true', default=False, help='Check packages with minimal facts and a single task per host, using the free strategy')
+    parser.add_argument('--snapshot-store', default=os.path.join(os.path.expanduser('~'), '.cache', 'unmanaged_packages', 'snapshots.db'), help='SQLite file to save package snapshots in')
+    parser.add_argument('--no-snapshot', dest='snapshot_store', action='store_const', const=None, help="Don't save a snapshot of this run")
+    # Not --diff, which ansible-playbook uses to show changes in check mode
+    diff = parser.add_mutually_exclusive_group()
+    diff.add_argument('--since-last', dest='diff', action='store_const', const='latest', default=None, help='Only report unmanaged packages added or removed since the latest snapshot')
+    diff.add_argument('--diff-snapshot', dest='diff', type=snapshot_id, metavar='SNAPSHOT', help='Only report unmanaged packages added or removed since the snapshot with this id')
+    parser.add_argument('--aggregate', action='store_true', default=False, help='Report the packages unmanaged on the most hosts')
+    parser.add_argument('--top', type=int, default=20, help='Number of packages, hosts and tasks to list in summaries')
+    parser.add_argument('--jsonl', default=None, metavar='PATH', help='Write results and task timings as JSON lines while running, - for stdout')
+    parser.add_argument('--timing', action='store_true', default=False, help='Report the slowest hosts and tasks')
+    return parser
+
+def main(argv=None, prog=None):
+    '''Run the playbook in check mode and report the packages on each host which it doesn't install.
+    Ansible is only imported once our own options have been parsed, so --help doesn't need to load it.
+    '''
+    # Take out our own options, the rest are passed on to ansible-playbook
+    argv = sys.argv[1:] if argv is None else argv
+    parser = get_parser(prog)
+    package_check_args, remaining_args = parser.parse_known_args(argv)
+    if package_check_args.help:
+        parser.print_help()
+        return
+
+    from ansible import context
+    from ansible import constants as C
+    from ansible.cli import CLI
+    from ansible.cli.playbook import PlaybookCLI
+    from ansible.errors import AnsibleError
+    from ansible.utils.color import stringc
+    from ansible.utils.collection_loader import AnsibleCollectionLoader, get_collection_name_from_path, set_collection_playbook_paths
+    from ansible.utils.display import Display
+    from ansible.module_utils.common.collections import ImmutableDict
+    from ansible.module_utils._text import to_bytes
+    from ansible.module_utils._text import to_text
+    from ansible.playbook.play import Play
+    from ansible.executor.playbook_executor import PlaybookExecutor
+    from ansible.executor.task_queue_manager import TaskQueueManager
+    from ansible.plugins.loader import add_all_plugin_dirs
+    from package_check import CallbackModule
+    display = Display()
+
+    # Read all the arguments from the cli
+    args = [to_text(a, errors='surrogate_or_strict') for a in [prog or sys.argv[0]] + remaining_args]
+
+    # Initialise our custom callback
+    jsonl = None
+    stdout = sys.stdout
+    if package_check_args.jsonl == '-':
+        # Keep stdout for the JSONL results only, everything else printed by ansible (play banners, skipped and failed
+        # hosts, warnings) or by the callback goes to stderr for the rest of the run
+        jsonl = stdout
+        sys.stdout = sys.stderr
+    elif package_check_args.jsonl:
+        jsonl = open(package_check_args.jsonl, 'w')
+    results_callback = CallbackModule(jsonl, package_check_args.manifest_cache, package_check_args.manifest_max_age)
+
+    # Ensure dry-run option is specified
+    if '--check' not in args:
+        args.append('--check')
+
+    pb_cli = PlaybookCLI(args)
+    pb_cli.parse()
+
+    #####################################################################
+    ### Execute a playbook
+    # This section is copied directly from: https://github.com/ansible/ansible/blob/stable-2.9/lib/ansible/cli/playbook.py#L71
+
+    # manages passwords
+    sshpass = None
+    becomepass = None
+    passwords = {}
+
+    b_playbook_dirs = []
+    for playbook in context.CLIARGS['args']:
+        if not os.path.exists(playbook):
+            raise AnsibleError("the playbook: %s could not be found" % playbook)
+        if not (os.path.isfile(playbook) or stat.S_ISFIFO(os.stat(playbook).st_mode)):
+            raise AnsibleError("the playbook: %s does not appear to be a file" % playbook)
+
+        b_playbook_dir = os.path.dirname(os.path.abspath(to_bytes(playbook, errors='surrogate_or_strict')))
+        # load plugins from all playbooks in case they add callbacks/inventory/etc
+        add_all_plugin_dirs(b_playbook_dir)
+
+        b_playbook_dirs.append(b_playbook_dir)
+
+    set_collection_playbook_paths(b_playbook_dirs)
+
+    playbook_collection = get_collection_name_from_path(b_playbook_dirs[0])
+
+    if playbook_collection:
+        display.warning("running playbook inside collection {0}".format(playbook_collection))
+        AnsibleCollectionLoader().set_default_collection(playbook_collection)
+
+    # don't deal with privilege escalation or passwords when we don't need to
+    if not (context.CLIARGS['listhosts'] or context.CLIARGS['listtasks'] or
+            context.CLIARGS['listtags'] or context.CLIARGS['syntax']):
+        (sshpass, becomepass) = pb_cli.ask_passwords()
+        passwords = {'conn_pass': sshpass, 'become_pass': becomepass}
+
+    # create base objects
+    loader, inventory, variable_manager = pb_cli._play_prereqs()
+
+    # Fix this when we rewrite inventory by making localhost a real host (and thus show up in list_hosts())
+    hosts = CLI.get_host_list(inventory, context.CLIARGS['subset'])
+
+    # flush fact cache if requplaybook_pathested
+    if context.CLIARGS['flush_cache']:
+        pb_cli._flush_cache(inventory, variable_manager)
+
+    ######################################################################
+
+    # Execute the playbook file
+    pbex = PlaybookExecutor(
+        playbooks=context.CLIARGS['args'],
+        inventory=inventory,
+        variable_manager=variable_manager,
+        loader=loader,
+        passwords=passwords,
+        )
+    # Override the default stdout callback with our custom callback
+    pbex._tqm._stdout_callback = results_callback
+    results = pbex.run()
+
+    # create base objects again (as PlaybookExecutor cleans them up)
+    loader, inventory, variable_manager = pb_cli._play_prereqs()
+
+    # Get list of hosts that the playbook successfully ran install tasks on
+    hosts = list(results_callback.package_info.keys())
+
+    if hosts and package_check_args.fast:
+        # Only gather the minimal facts needed for the release, and get the packages in one task. The free strategy lets
+        # each host finish as soon as it can instead of waiting for the slowest host at every task
+        play_source = {
+        "hosts": hosts,
+        "gather_facts": True,
+        "gather_subset": ["!all"],
+        "strategy": "free",
+        "become": False,
+        "tasks": [
+            {
+            "name": "package_check - get release and manually installed packages",
+            "shell": "set -o pipefail && echo '{{ ansible_distribution_version }} {{ (ansible_lsb.get('description') | regex_findall('[0-9\\.]+')).0 }}' && apt-mark showmanual | sort -u",
+            "args": {
+                "executable": "/bin/bash"
             }
-        else:
-            self.package_info[h]["failed"] = True
-
-        super(CallbackModule, self).v2_runner_on_failed(result)
-
-    def v2_playbook_on_stats(self, stats):
-        if self._display.verbosity:
-            super(CallbackModule, self).v2_playbook_on_stats(stats)
-
-    def v2_playbook_on_task_start(self, task, is_conditional):
-        if self._display.verbosity:
-            super(CallbackModule, self).v2_playbook_on_task_start(task, is_conditional)
-
-    def v2_runner_item_on_ok(self, result):
-        if self._display.verbosity:
-            super(CallbackModule, self).v2_runner_item_on_ok(result)
-
-    def v2_runner_item_on_failed(self, result):
-        h = result._host.get_name()
-        if h not in self.package_info:
-            self.package_info[h] = {
-                    "manual": set(),
-                    "managed": set(),
-                    "failed": True
             }
-        else:
-            self.package_info[h]["failed"] = True
-        super(CallbackModule, self).v2_runner_item_on_failed(result)
-
-# Initialise our custom callback
-results_callback = CallbackModule()
-
-# Read all the arguments from the cli
-args = [to_text(a, errors='surrogate_or_strict') for a in sys.argv]
-
-# Ensure dry-run option is specified
-if '--check' not in args:
-    args.append('--check')
-
-pb_cli = PlaybookCLI(args)
-pb_cli.parse()
-
-#####################################################################
-### Execute a playbook
-# This section is copied directly from: https://github.com/ansible/ansible/blob/stable-2.9/lib/ansible/cli/playbook.py#L71
-
-# manages passwords
-sshpass = None
-becomepass = None
-passwords = {}
-
-b_playbook_dirs = []
-for playbook in context.CLIARGS['args']:
-    if not os.path.exists(playbook):
-        raise AnsibleError("the playbook: %s could not be found" % playbook)
-    if not (os.path.isfile(playbook) or stat.S_ISFIFO(os.stat(playbook).st_mode)):
-        raise AnsibleError("the playbook: %s does not appear to be a file" % playbook)
-
-    b_playbook_dir = os.path.dirname(os.path.abspath(to_bytes(playbook, errors='surrogate_or_strict')))
-    # load plugins from all playbooks in case they add callbacks/inventory/etc
-    add_all_plugin_dirs(b_playbook_dir)
-    
-    b_playbook_dirs.append(b_playbook_dir)
-
-set_collection_playbook_paths(b_playbook_dirs)
-
-playbook_collection = get_collection_name_from_path(b_playbook_dirs[0])
-
-if playbook_collection:
-    display.warning("running playbook inside collection {0}".format(playbook_collection))
-    AnsibleCollectionLoader().set_default_collection(playbook_collection)
-
-# don't deal with privilege escalation or passwords when we don't need to
-if not (context.CLIARGS['listhosts'] or context.CLIARGS['listtasks'] or
-        context.CLIARGS['listtags'] or context.CLIARGS['syntax']):
-    (sshpass, becomepass) = pb_cli.ask_passwords()
-    passwords = {'conn_pass': sshpass, 'become_pass': becomepass}
-
-# create base objects
-loader, inventory, variable_manager = pb_cli._play_prereqs()
+        ]
+        }
+    elif hosts:
+        play_source = {
+        "hosts": hosts,
+        "gather_facts": True,
+        "become": False,
+        "tasks": [
+            {
+            "name": "package_check - get ubuntu version",
+            "set_fact": {
+                "ubuntu_version": "{{ ansible_lsb.get('description') | regex_findall('[0-9\\.]+') }}"
+            }
+            },
+            {
+            "name": "package_check - get manually installed packages",
+            "shell": "set -o pipefail && apt-mark showmanual | sort -u",
+            "args": {
+                "executable": "/bin/bash"
+            },
+            "register": "manual_installed_packages"
+            },
+            {
+            "name": "package_check - get real manually installed packages",
+            "set_fact": {
+                "manual_packages": "{{ manual_installed_packages.stdout_lines }}",
+                "manifest_release": "{{ ansible_distribution_version }}",
+                "manifest_version": "{{ ubuntu_version.0 }}"
+            }
+            }
+        ]
+        }
 
-# Fix this when we rewrite inventory by making localhost a real host (and thus show up in list_hosts())
-hosts = CLI.get_host_list(inventory, context.CLIARGS['subset'])
+    if hosts:
+        # Get the cli options from the current context
+        options = context.CLIARGS._store
+        play_options = copy(options)
+        # Ensure --check option is disabled
+        if play_options.get('check') != False:
+            play_options['check'] = False
+        # Ensure all tags are cleared
+        if play_options.get('tags'):
+            play_options['tags'] = ()
+        if play_options.get('skip_tags'):
+            play_options['skip_tags'] = ()
+
+        # Override the current context
+        context.CLIARGS = ImmutableDict(**play_options)
+
+        # Create play object, playbook objects use .load instead of init or new methods,
+        # this will also automatically create the task objects from the info provided in play_source
+        play = Play().load(play_source, variable_manager=variable_manager, loader=loader)
+
+        # Run it - instantiate task queue manager, which takes care of forking and setting up all objects to iterate over host list and tasks
+        tqm = None
+        try:
+            tqm = TaskQueueManager(
+                    inventory=inventory,
+                    variable_manager=variable_manager,
+                    loader=loader,
+                    passwords=passwords,
+                    stdout_callback=results_callback,
+                    forks=context.CLIARGS.get('forks')
+                )
+            result = tqm.run(play) # most interesting data for a play is actually sent to the callback's methods
+        finally:
+            # we always need to cleanup child procs and the structures we use to communicate with them
+            if tqm is not None:
+                tqm.cleanup()
+
+            # Remove ansible tmpdir
+            shutil.rmtree(C.DEFAULT_LOCAL_TMP, True)
+
+        # Fetch each distinct Ubuntu manifest once on the controller instead of on every host
+        remove_manifest_packages(results_callback.package_info, package_check_args.manifest_cache, package_check_args.manifest_max_age, results_callback.manifests)
+    else:
+        print("Failed to create managed package list", file=sys.stderr)
+
+    results_callback.finish(package_check_args.top, package_check_args.timing and jsonl is not stdout)
+    if jsonl is not None and jsonl is not stdout:
+        jsonl.close()
+
+    # Find the snapshot to diff against before saving this run as the latest snapshot
+    store, previous, snapshot_id = None, None, None
+    if package_check_args.snapshot_store:
+        store = open_store(package_check_args.snapshot_store)
+        if package_check_args.diff:
+            previous_id = find_snapshot(store, package_check_args.diff)
+            if previous_id is None:
+                print("No snapshot %s to diff against, showing all unmanaged packages" % package_check_args.diff, file=sys.stderr)
+            else:
+                # Diff hosts which failed in that snapshot against the last time their check succeeded
+                previous = load_snapshot(store, previous_id, carry_forward=True)
+        if results_callback.package_info:
+            snapshot_id = save_snapshot(store, results_callback.package_info)
+
+    # The text report is replaced by the JSONL results when they are written to stdout
+    if jsonl is not stdout:
+        if previous is not None:
+            results_callback._display.banner("UNMANAGED PACKAGE CHANGES SINCE SNAPSHOT %d" % previous_id)
+            print_diff(results_callback.package_info, previous)
+        else:
+            # Print banner title
+            results_callback._display.banner("UNMANAGED PACKAGE LIST")
+            # Print summary of results
+            for hostname, value in results_callback.package_info.items():
+                if not results_callback.package_info[hostname]['failed']:
+                    print("SUCCESS => %s:" % stringc(hostname, "green"))
+                    for p in results_callback.package_info[hostname]['manual'] - results_callback.package_info[hostname]['managed']:
+                        print("  - %s" % p)
+                else:
+                    print("FAILED => %s:" % stringc(hostname, "red"))
 
-# flush fact cache if requplaybook_pathested
-if context.CLIARGS['flush_cache']:
-    pb_cli._flush_cache(inventory, variable_manager)
+        if package_check_args.aggregate:
+            results_callback._display.banner("FLEET-WIDE UNMANAGED PACKAGES")
+            print_aggregates(results_callback.package_info, package_check_args.top)
 
-######################################################################
+    if snapshot_id is not None:
+        print("Saved snapshot %d to %s" % (snapshot_id, package_check_args.snapshot_store), file=sys.stderr)
+    sys.stdout = stdout
 
-# Execute the playbook file
-pbex = PlaybookExecutor(
-    playbooks=context.CLIARGS['args'],
-    inventory=inventory,
-    variable_manager=variable_manager,
-    loader=loader,
-    passwords=passwords,
-    )
-# Override the default stdout callback with our custom callback
-pbex._tqm._stdout_callback = results_callback
-results = pbex.run()
-
-# create base objects again (as PlaybookExecutor cleans them up)
-loader, inventory, variable_manager = pb_cli._play_prereqs()
-
-# Get list of hosts that the playbook successfully ran install tasks on
-hosts = list(results_callback.package_info.keys())
-
-if hosts:
-    play_source = {
-    "hosts": hosts,
-    "gather_facts": True,
-    "become": False,
-    "tasks": [
-        {
-        "name": "package_check - get ubuntu version",
-        "set_fact": {
-            "ubuntu_version": "{{ ansible_lsb.get('description') | regex_findall('[0-9\\.]+') }}"
-        }
-        },
-        {
-        "name": "package_check - get ubuntu manifest packages",
-        "shell": "set -o pipefail && wget 'http://releases.ubuntu.com/releases/{{ ansible_distribution_version }}/ubuntu-{{ ubuntu_version.0 }}-desktop-amd64.manifest' -q -O - | cut -f 1 | sort -u",
-        "args": {
-            "executable": "/bin/bash"
-        },
-        "register": "ubuntu_manifest_packages"
-        },
-        {
-        "name": "package_check - get manually installed packages",
-        "shell": "set -o pipefail && apt-mark showmanual | sort -u",
-        "args": {
-            "executable": "/bin/bash"
-        },
-        "register": "manual_installed_packages"
-        },
-        {
-        "name": "package_check - get real manually installed packages",
-        "set_fact": {
-            "manual_packages": "{{ manual_installed_packages.stdout_lines | difference(ubuntu_manifest_packages.stdout_lines) }}"
-        }
-        }
-    ]
-    }
-
-    # Get the cli options from the current context
-    options = context.CLIARGS._store
-    play_options = copy(options)
-    # Ensure --check option is disabled
-    if play_options.get('check') != False:
-        play_options['check'] = False
-    # Ensure all tags are cleared
-    if play_options.get('tags'):
-        play_options['tags'] = ()
-    if play_options.get('skip_tags'):
-        play_options['skip_tags'] = ()
-
-    # Override the current context
-    context.CLIARGS = ImmutableDict(**play_options)
-
-    # Create play object, playbook objects use .load instead of init or new methods,
-    # this will also automatically create the task objects from the info provided in play_source
-    play = Play().load(play_source, variable_manager=variable_manager, loader=loader)
-
-    # Run it - instantiate task queue manager, which takes care of forking and setting up all objects to iterate over host list and tasks
-    tqm = None
-    try:
-        tqm = TaskQueueManager(
-                inventory=inventory,
-                variable_manager=variable_manager,
-                loader=loader,
-                passwords=passwords,
-                stdout_callback=results_callback
-            )
-        result = tqm.run(play) # most interesting data for a play is actually sent to the callback's methods
-    finally:
-        # we always need to cleanup child procs and the structures we use to communicate with them
-        if tqm is not None:
-            tqm.cleanup()
-
-        # Remove ansible tmpdir
-        shutil.rmtree(C.DEFAULT_LOCAL_TMP, True)
-else:
-    print("Failed to create managed package list")
-
-# Print banner title
-results_callback._display.banner("UNMANAGED PACKAGE LIST")
-# Print summary of results
-for hostname, value in results_callback.package_info.items():
-    if not results_callback.package_info[hostname]['failed']:
-        print("SUCCESS => %s:" % stringc(hostname, "green"))
-        for p in results_callback.package_info[hostname]['manual'] - results_callback.package_info[hostname]['managed']:
-            print("  - %s" % p)
-    else:
-        print("FAILED => %s:" % stringc(hostname, "red"))
 
+if __name__ == '__main__':
+    main()